@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ (c) 2014 - Copyright Red Hat Inc
+
+ Authors:
+   Pierre-Yves Chibon <pingou@pingoured.fr>
+
+License: GPLv3 or any later version.
+
+Offline end-to-end benchmark of dgroc: synthetic git and hg repositories
+are built against a local fake copr server and the wall time as well as
+the time spent in each stage is reported for each number of projects.
+"""
+
+import argparse
+import ConfigParser
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import dgroc
+import fakecopr
+
+
+SIZES = [1, 10, 100, 1000]
+SPEC_TEMPLATE = '''Name:           %(name)s
+Version:        1.0
+Release:        1%%{?dist}
+Summary:        Synthetic project of the dgroc benchmark
+License:        GPLv3+
+Source0:        %(name)s.tar
+BuildArch:      noarch
+
+%%description
+Synthetic project generated by the dgroc benchmark.
+
+%%prep
+%%setup -q -n %(name)s
+
+%%build
+
+%%install
+
+%%files
+
+%%changelog
+* Mon Jan 06 2014 dgroc <dgroc@example.com> - 1.0-1
+- Initial package
+'''
+# Author of the commits of the synthetic repositories
+AUTHOR = 'dgroc benchmark <dgroc@example.com>'
+
+
+def run(cmd, cwd):
+    ''' Run the command, failing loudly. '''
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(cmd, cwd=cwd, stdout=devnull)
+
+
+def make_repository(scm, folder, name, size):
+    ''' Create a repository with a single commit holding ``size`` KiB of
+    data.
+    '''
+    os.makedirs(folder)
+    with open(os.path.join(folder, 'README'), 'w') as stream:
+        stream.write('%s: synthetic project of the dgroc benchmark\n' % name)
+    with open(os.path.join(folder, 'data.txt'), 'w') as stream:
+        for _ in range(size * 16):
+            stream.write('%064x\n' % random.getrandbits(256))
+
+    if scm == 'git':
+        run(['git', 'init', '-q'], folder)
+    elif scm == 'hg':
+        run(['hg', 'init'], folder)
+    else:
+        raise ValueError('Unknown scm: %s' % scm)
+    commit(scm, folder, 'Initial commit')
+
+
+def commit(scm, folder, message):
+    ''' Commit all the files of the repository. '''
+    if scm == 'git':
+        run(['git', 'add', '.'], folder)
+        author, email = AUTHOR[:-1].split(' <')
+        run(['git', '-c', 'user.name=%s' % author, '-c',
+             'user.email=%s' % email, 'commit', '-q', '-m', message], folder)
+    else:
+        run(['hg', 'commit', '-q', '-A', '-u', AUTHOR, '-m', message], folder)
+
+
+def make_projects(workdir, count, scms, size, copr_url, args):
+    ''' Create ``count`` synthetic projects and the dgroc configuration
+    file using them, returns the path to that file.
+    '''
+    config = ConfigParser.ConfigParser()
+    config.add_section('main')
+    config.set('main', 'username', 'dgroc')
+    config.set('main', 'email', 'dgroc@example.com')
+    config.set('main', 'copr_url', copr_url)
+    config.set('main', 'copr_config', os.path.join(workdir, 'copr'))
+    config.set('main', 'state_file', os.path.join(workdir, 'state.sqlite'))
+    config.set('main', 'workspace_dir', os.path.join(workdir, 'workspaces'))
+    config.set('main', 'srpm_cache_dir', os.path.join(workdir, 'srpms'))
+    config.set('main', 'archive_format', args.archive_format)
+    config.set('main', 'monitor_interval', '1')
+    config.set('main', 'monitor_max_interval', '2')
+
+    copr = ConfigParser.ConfigParser()
+    copr.add_section('copr-cli')
+    copr.set('copr-cli', 'username', 'dgroc')
+    copr.set('copr-cli', 'login', 'dgroc')
+    copr.set('copr-cli', 'token', 'dgroc')
+    copr.set('copr-cli', 'copr_url', copr_url)
+    with open(os.path.join(workdir, 'copr'), 'w') as stream:
+        copr.write(stream)
+
+    for folder in ('upstream', 'clones', 'specs'):
+        os.makedirs(os.path.join(workdir, folder))
+    for index in range(count):
+        scm = scms[index % len(scms)]
+        name = 'bench%04d' % index
+        upstream = os.path.join(workdir, 'upstream', name)
+        make_repository(scm, upstream, name, size)
+        spec_file = os.path.join(workdir, 'specs', '%s.spec' % name)
+        with open(spec_file, 'w') as stream:
+            stream.write(SPEC_TEMPLATE % {'name': name})
+
+        config.add_section(name)
+        config.set(name, 'scm', scm)
+        config.set(name, '%s_url' % scm, 'file://%s' % upstream)
+        config.set(name, '%s_folder' % scm,
+                   os.path.join(workdir, 'clones', name))
+        config.set(name, 'spec_file', spec_file)
+        config.set(name, 'spec_template', 'True')
+        config.set(name, 'copr', 'bench%d' % (index % args.coprs))
+        if scm == 'git':
+            # Copr only builds git repositories from scm
+            config.set(name, 'build_method', args.build_method)
+
+    config_file = os.path.join(workdir, 'dgroc.cfg')
+    with open(config_file, 'w') as stream:
+        config.write(stream)
+    return config_file
+
+
+def run_dgroc(config_file, args, monitoring=True):
+    ''' Run dgroc on the configuration file with the options of the
+    benchmark.
+    '''
+    cmd = ['dgroc', '--config', config_file, '--jobs', str(args.jobs),
+           '--upload-jobs', str(args.upload_jobs),
+           '--submit-jobs', str(args.submit_jobs)]
+    if not monitoring:
+        cmd.append('--no-monitoring')
+    argv = sys.argv
+    sys.argv = cmd
+    try:
+        dgroc.main()
+    finally:
+        sys.argv = argv
+
+
+def benchmark(count, args):
+    ''' Run dgroc on ``count`` synthetic projects and return the results. '''
+    workdir = tempfile.mkdtemp(
+        prefix='dgroc-bench-%s-' % count, dir=args.workdir)
+    server = fakecopr.FakeCoprServer(
+        ('127.0.0.1', 0), fakecopr.FakeCopr(build_time=args.build_time),
+        latency=args.latency).start()
+    try:
+        start = time.time()
+        config_file = make_projects(
+            workdir, count, args.scm, args.size, server.url, args)
+        setup = time.time() - start
+
+        start = time.time()
+        run_dgroc(config_file, args, monitoring=args.monitoring)
+        wall = time.time() - start
+        metrics = dgroc.METRICS.report()
+    finally:
+        server.stop()
+        if not args.keep:
+            shutil.rmtree(workdir)
+
+    return {
+        'projects': count,
+        'setup': round(setup, 3),
+        'wall': round(wall, 3),
+        'stages': metrics['stages'],
+        'counters': metrics['counters'],
+        'builds': len(server.copr.builds),
+        'copr_requests': server.copr.requests,
+    }
+
+
+def check_cancel(args):
+    ''' Submit two commits of a single git project to the fake copr, the
+    second one before the build of the first one started, and return
+    whether the first build was cancelled while the second one goes on.
+    '''
+    workdir = tempfile.mkdtemp(prefix='dgroc-cancel-', dir=args.workdir)
+    server = fakecopr.FakeCoprServer(
+        ('127.0.0.1', 0), fakecopr.FakeCopr(build_time=3600),
+        latency=args.latency).start()
+    try:
+        config_file = make_projects(
+            workdir, 1, ['git'], args.size, server.url, args)
+        run_dgroc(config_file, args, monitoring=False)
+        upstream = os.path.join(workdir, 'upstream', 'bench0000')
+        with open(os.path.join(upstream, 'README'), 'a') as stream:
+            stream.write('Second commit\n')
+        commit('git', upstream, 'Second commit')
+        run_dgroc(config_file, args, monitoring=False)
+    finally:
+        server.stop()
+        if not args.keep:
+            shutil.rmtree(workdir)
+
+    statuses = [
+        server.copr.status(build_id)
+        for build_id in sorted(server.copr.builds)]
+    print('Builds: %s' % ', '.join(statuses))
+    return statuses == ['canceled', 'pending']
+
+
+def print_results(results, reference=None):
+    ''' Print the results, compared to the reference results if any. '''
+    previous = {}
+    if reference:
+        previous = dict(
+            (result['projects'], result) for result in reference['results'])
+
+    for result in results:
+        old = previous.get(result['projects'])
+        line = '%5s projects: %9.3fs wall, %s builds' % (
+            result['projects'], result['wall'], result['builds'])
+        if old:
+            line += ' (was %.3fs, x%.2f)' % (
+                old['wall'], result['wall'] / (old['wall'] or 1))
+        print(line)
+        for stage in sorted(result['stages']):
+            entry = result['stages'][stage]
+            line = '    %-10s %6s calls %9.3fs total %9.3fs span' % (
+                stage, entry['calls'], entry['seconds'], entry['span'])
+            if old and stage in old['stages']:
+                line += ' (was %.3fs total)' % (
+                    old['stages'][stage]['seconds'])
+            print(line)
+
+
+def get_arguments():
+    ''' Set the command line parser and retrieve the arguments provided
+    by the command line.
+    '''
+    parser = argparse.ArgumentParser(
+        description='Offline end-to-end benchmark of dgroc')
+    parser.add_argument(
+        '--projects', default=','.join(str(size) for size in SIZES),
+        help='Comma separated numbers of projects to benchmark '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '--scm', default='git,hg',
+        help='Comma separated scms the projects use in turn '
+        '(default: %(default)s)')
+    parser.add_argument(
+        '--size', type=int, default=64,
+        help='Size, in KiB, of the data in each repository')
+    parser.add_argument(
+        '--coprs', type=int, default=1,
+        help='Number of coprs the projects are spread over')
+    parser.add_argument(
+        '--archive-format', dest='archive_format', default='tar.gz',
+        choices=sorted(dgroc.ARCHIVE_FORMATS),
+        help='Format of the source archives')
+    parser.add_argument(
+        '--build-method', dest='build_method', default='srpm',
+        choices=dgroc.BUILD_METHODS,
+        help='How the git projects are built in copr (default: %(default)s)')
+    parser.add_argument(
+        '--jobs', '-j', type=int, default=1,
+        help='Number of projects to generate the source rpm of in parallel')
+    parser.add_argument(
+        '--upload-jobs', dest='upload_jobs', type=int, default=1,
+        help='Number of source rpms to upload in parallel')
+    parser.add_argument(
+        '--submit-jobs', dest='submit_jobs', type=int, default=2,
+        help='Number of builds to start in copr in parallel')
+    parser.add_argument(
+        '--build-time', dest='build_time', type=float, default=2,
+        help='Number of seconds a build takes in the fake copr')
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='Number of seconds added to each request to the fake copr')
+    parser.add_argument(
+        '--no-monitoring', dest='monitoring', action='store_false',
+        default=True,
+        help='Do not wait for the builds to finish')
+    parser.add_argument(
+        '--workdir', default=None,
+        help='Folder in which the synthetic projects are created')
+    parser.add_argument(
+        '--keep', action='store_true', default=False,
+        help='Keep the synthetic projects once the benchmark is done')
+    parser.add_argument(
+        '--output', default=None,
+        help='JSON file in which the results are saved (default: '
+        'dgroc-benchmark-<date>.json)')
+    parser.add_argument(
+        '--compare', default=None, metavar='JSON',
+        help='Results of a previous run to compare with')
+    parser.add_argument(
+        '--check-cancel', dest='check_cancel', action='store_true',
+        default=False,
+        help='Instead of benchmarking, check that a build superseded by a '
+        'newer commit is cancelled')
+    parser.add_argument(
+        '--debug', action='store_true', default=False,
+        help='Show the output of dgroc')
+
+    args = parser.parse_args()
+    args.projects = [int(size) for size in args.projects.split(',')]
+    args.scm = [scm.strip() for scm in args.scm.split(',')]
+    return args
+
+
+def main():
+    ''' Run the benchmark for each number of projects and save the results.
+    '''
+    args = get_arguments()
+    if not args.debug:
+        logging.getLogger().setLevel(logging.WARNING)
+        for handler in logging.getLogger().handlers:
+            handler.setLevel(logging.WARNING)
+
+    if args.check_cancel:
+        if not check_cancel(args):
+            print('The superseded build was not cancelled')
+            sys.exit(1)
+        print('The superseded build was cancelled')
+        return
+
+    reference = None
+    if args.compare:
+        with open(args.compare) as stream:
+            reference = json.load(stream)
+
+    started = datetime.now()
+    results = []
+    for count in args.projects:
+        print('Benchmarking %s projects...' % count)
+        results.append(benchmark(count, args))
+        print_results(results[-1:], reference)
+
+    report = {
+        'started': started.isoformat(),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'options': dict(
+            (key, value) for key, value in vars(args).items()
+            if key not in ('output', 'compare', 'debug', 'check_cancel')),
+        'results': results,
+    }
+    output = args.output or 'dgroc-benchmark-%s.json' % started.strftime(
+        '%Y%m%d-%H%M%S')
+    with open(output, 'w') as stream:
+        json.dump(report, stream, indent=2, sort_keys=True)
+    print('Results saved in %s' % output)
+
+
+if __name__ == '__main__':
+    main()
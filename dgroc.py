@@ -12,17 +12,32 @@ License: GPLv3 or any later version.
 
 import argparse
 import ConfigParser
-import datetime
+import contextlib
+import cProfile
+import fcntl
 import glob
+import hashlib
+import io
 import json
 import logging
 import os
-import rpm
+import pipes
+import Queue
+import random
+import re
 import subprocess
 import shutil
+import signal
+import sqlite3
+import stat
+import tarfile
+import tempfile
+import threading
 import time
+import uuid
 import warnings
 from datetime import date
+from email.utils import mktime_tz, parsedate_tz
 
 import requests
 try:
@@ -33,13 +48,103 @@ try:
     import hglib
 except ImportError:
     pass
+# The rpm bindings are only imported by the commands needing them, see
+# init_rpm()
+rpm = None
 
 
 DEFAULT_CONFIG = os.path.expanduser('~/.config/dgroc')
+DEFAULT_STATE = os.path.expanduser('~/.cache/dgroc/state.sqlite')
+# Number of remote repositories queried at the same time for new commits
+CHECK_JOBS = 8
+# Number of items that may wait between two stages of the pipeline, per
+# worker of the next stage
+QUEUE_SIZE = 2
+# Statuses of the copr builds that are not finished yet
+IN_PROGRESS = ('pending', 'starting', 'importing', 'running', 'waiting')
+# Statuses of the copr builds that did not start building yet
+NOT_STARTED = ('pending', 'importing', 'waiting')
+# Statuses of the superseded builds cancelled by each `cancel_superseded`
+# policy
+CANCEL_POLICIES = {'pending': NOT_STARTED, 'all': IN_PROGRESS, 'none': ()}
+# How the projects may be built in copr
+BUILD_METHODS = ('srpm', 'scm')
+# Body of the changelog entries added by dgroc
+AUTOMATED_ENTRY = re.compile(r'^- Update to (git|hg): [0-9a-fA-F]+$')
+# Number of seconds between two checks of a build, doubled every time the
+# build did not change up to the maximum
+MONITOR_INTERVAL = 30
+MONITOR_MAX_INTERVAL = 600
+# Number of consecutive failed checks after which a build is given up on
+MONITOR_MAX_ERRORS = 10
+# Number of builds checked at the same time
+MONITOR_JOBS = 8
+# Size of the chunks in which the source rpms are read and sent
+CHUNK_SIZE = 1024 * 1024
+# Maximum number of source rpms sent to the `upload_target` in one transfer
+UPLOAD_BATCH_SIZE = 50
+# Number of seconds the ssh connection to the `upload_target` is kept open
+# once unused
+SSH_PERSIST = 60
+# Number of connections kept open to copr
+COPR_POOL_SIZE = 10
+# Number of seconds the project ids and chroots of a copr are cached
+COPR_CACHE_TTL = 3600
+# Number of requests per second sent to copr, 0 for no limit
+COPR_RATE = 10
+# Number of times a request failing with a transient error is retried, the
+# delay before each retry doubling up to the maximum, a request copr asks to
+# retry later than the maximum is given up on
+COPR_RETRIES = 5
+COPR_RETRY_DELAY = 1
+COPR_MAX_RETRY_DELAY = 60
+# Number of seconds after which a request to copr is given up on
+COPR_TIMEOUT = 60
+# Command compressing, from stdin to stdout, the archives of each format
+ARCHIVE_FORMATS = {
+    'tar': None,
+    'tar.gz': ['gzip', '--no-name', '--stdout'],
+    'tar.xz': ['xz', '--threads=%(threads)s', '--stdout'],
+    'tar.zst': ['zstd', '--threads=%(threads)s', '--quiet', '--stdout'],
+}
 COPR_URL = 'https://copr.fedorainfracloud.org/'
+# Number of days after which an unused project workspace is removed
+WORKSPACE_MAX_AGE = 7
+# Number of seconds after which a git lock file is deemed left behind by an
+# interrupted operation rather than held by one still running
+STALE_LOCK_AGE = 600
+# Weight of the last run in the average durations recorded for each project
+HISTORY_WEIGHT = 0.3
+# Folder and maximum size, in bytes, of the cache of source rpms
+SRPM_CACHE_DIR = os.path.expanduser('~/.cache/dgroc/srpms')
+SRPM_CACHE_SIZE = 2 * 1024 ** 3
+# Default number of seconds between two checks of a project by the daemon
+SERVE_INTERVAL = 24 * 3600
+# Maximum number of seconds the daemon sleeps before looking at its schedule
+SERVE_MAX_SLEEP = 60
 # Initial simple logging stuff
 logging.basicConfig(format='%(message)s')
 LOG = logging.getLogger("dgroc")
+# The rpm bindings keep a global macro context, so only one thread at a
+# time may parse a spec file or expand macros.
+RPM_LOCK = threading.Lock()
+# rpm macros already expanded, see get_rpm_macro()
+_RPM_MACROS = {}
+# Spec files already parsed, see parse_spec()
+SPEC_LOCK = threading.Lock()
+_SPEC_CACHE = {}
+# Only one thread at a time may evict source rpms from the cache
+SRPM_CACHE_LOCK = threading.Lock()
+# Expansions of the globs of the `patch_files` options, see get_patches()
+GLOB_LOCK = threading.Lock()
+_GLOB_CACHE = {}
+# ioctl cloning a file on the filesystems supporting reflinks
+FICLONE = 0x40049409
+# Mirrors of the upstream git repositories already fetched in this run, see
+# update_mirror()
+MIRROR_LOCK = threading.Lock()
+_MIRROR_LOCKS = {}
+_MIRRORS_FETCHED = set()
 
 
 class DgrocException(Exception):
@@ -49,41 +154,435 @@ class DgrocException(Exception):
     pass
 
 
-class GitReader(object):
+class Metrics(object):
+    ''' Timers and counters of the stages of a run, overall and for each
+    project, exported as a JSON report or a Prometheus textfile.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.profile_dir = None
+        self.reset()
+
+    def reset(self):
+        ''' Forget everything recorded so far and start a new run. '''
+        with self._lock:
+            self.started = time.time()
+            # stage -> [calls, seconds, max, first start, last end]
+            self.stages = {}
+            # name -> value
+            self.counters = {}
+            # project -> {'stages': {stage: seconds}, 'counters': {}}
+            self.projects = {}
+
+    def _project(self, project):
+        ''' Return the metrics of the project, the lock must be held. '''
+        return self.projects.setdefault(
+            project, {'stages': {}, 'counters': {}})
+
+    @contextlib.contextmanager
+    def timer(self, stage, project=None):
+        ''' Time the block as part of the stage, and of the project. '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, start, time.time(), project=project)
+
+    def record(self, stage, start, end, project=None):
+        ''' Record a call to the stage lasting from start to end. '''
+        with self._lock:
+            entry = self.stages.setdefault(stage, [0, 0.0, 0.0, start, end])
+            entry[0] += 1
+            entry[1] += end - start
+            entry[2] = max(entry[2], end - start)
+            entry[3] = min(entry[3], start)
+            entry[4] = max(entry[4], end)
+            if project is not None:
+                stages = self._project(project)['stages']
+                stages[stage] = stages.get(stage, 0.0) + end - start
+
+    def count(self, name, value=1, project=None):
+        ''' Add the value to the counter, and to the one of the project. '''
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            if project is not None:
+                counters = self._project(project)['counters']
+                counters[name] = counters.get(name, 0) + value
+
+    def profile(self, project, function, *args, **kwargs):
+        ''' Call the function, under cProfile if a profile folder is set,
+        the profile being dumped to <profile_dir>/<project>.prof.
+        '''
+        if not self.profile_dir:
+            return function(*args, **kwargs)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            _makedirs(self.profile_dir)
+            profile.dump_stats(
+                os.path.join(self.profile_dir, '%s.prof' % project))
+
+    def report(self):
+        ''' Return the metrics recorded as a dict. '''
+        with self._lock:
+            return {
+                'started': self.started,
+                'duration': round(time.time() - self.started, 3),
+                'stages': dict(
+                    (stage, {
+                        'calls': entry[0],
+                        'seconds': round(entry[1], 3),
+                        'max': round(entry[2], 3),
+                        'span': round(entry[4] - entry[3], 3),
+                    })
+                    for stage, entry in self.stages.items()),
+                'counters': dict(self.counters),
+                'projects': dict(
+                    (project, {
+                        'stages': dict(
+                            (stage, round(seconds, 3))
+                            for stage, seconds in data['stages'].items()),
+                        'counters': dict(data['counters']),
+                    })
+                    for project, data in self.projects.items()),
+            }
+
+    def write_json(self, filename):
+        ''' Write the JSON report of the run. '''
+        write_atomic(filename, [json.dumps(
+            self.report(), indent=2, sort_keys=True)])
+
+    def write_prometheus(self, filename):
+        ''' Write the metrics in the format of the textfile collector of the
+        Prometheus node exporter.
+        '''
+        report = self.report()
+        rows = []
+
+        def _metric(name, kind, helptext, samples):
+            ''' Add the rows of a metric and its samples, if any. '''
+            if not samples:
+                return
+            rows.append('# HELP dgroc_%s %s' % (name, helptext))
+            rows.append('# TYPE dgroc_%s %s' % (name, kind))
+            for labels, value in samples:
+                labels = ','.join(
+                    '%s="%s"' % (key, _escape(labels[key]))
+                    for key in sorted(labels))
+                if isinstance(value, float):
+                    value = '%.3f' % value
+                rows.append('dgroc_%s%s %s' % (
+                    name, '{%s}' % labels if labels else '', value))
+
+        def _escape(value):
+            ''' Escape a label value. '''
+            return str(value).replace('\\', '\\\\').replace(
+                '"', '\\"').replace('\n', '\\n')
+
+        stages = sorted(report['stages'].items())
+        _metric('run_start_timestamp_seconds', 'gauge',
+                'Time the last run started at.', [({}, report['started'])])
+        _metric('run_duration_seconds', 'gauge',
+                'Duration of the last run.', [({}, report['duration'])])
+        _metric('stage_seconds', 'gauge',
+                'Time spent in each stage, summed over all the threads.',
+                [({'stage': stage}, entry['seconds'])
+                 for stage, entry in stages])
+        _metric('stage_calls', 'gauge', 'Number of times each stage ran.',
+                [({'stage': stage}, entry['calls'])
+                 for stage, entry in stages])
+        _metric('stage_max_seconds', 'gauge',
+                'Longest time a single run of each stage took.',
+                [({'stage': stage}, entry['max'])
+                 for stage, entry in stages])
+        _metric('project_stage_seconds', 'gauge',
+                'Time spent in each stage for each project.',
+                [({'project': project, 'stage': stage}, seconds)
+                 for project, data in sorted(report['projects'].items())
+                 for stage, seconds in sorted(data['stages'].items())])
+        for name, value in sorted(report['counters'].items()):
+            _metric(name, 'gauge', 'Total of the %s counter.' % name,
+                    [({}, value)])
+            _metric('project_%s' % name, 'gauge',
+                    'Value of the %s counter for each project.' % name,
+                    [({'project': project}, data['counters'][name])
+                     for project, data in sorted(report['projects'].items())
+                     if name in data['counters']])
+        write_atomic(filename, rows)
+
+
+# Metrics of the current run
+METRICS = Metrics()
+
+
+class Reader(object):
+    '''Base of the version control system readers: a reader is opened on
+    the local clone of a project and keeps its handles on it until closed'''
+    short = None
+    # How the archives are generated by default, see make_archive()
+    archive_backend = 'internal'
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @classmethod
+    def options(cls, config, project):
+        '''Get the options of the project about how to clone and update
+        its repository'''
+        return {}
+
+    def close(self):
+        '''Release the handles kept on the repository'''
+        pass
+
+
+class GitReader(Reader):
     '''Defualt version control system to use: git'''
     short = 'git'
 
+    def __init__(self, folder):
+        super(GitReader, self).__init__(folder)
+        self._repo = None
+
     @classmethod
     def init(cls):
         '''Import the stuff git needs again and let it raise an exception now'''
         import pygit2
 
     @classmethod
-    def clone(cls, url, folder):
-        '''Clone the repository'''
-        pygit2.clone_repository(url, folder)
+    def options(cls, config, project):
+        '''Get the options of the project about how to clone and update
+        its repository'''
+        options = {}
+        if config.has_option(project, 'git_branch'):
+            options['branch'] = config.get(project, 'git_branch')
+        if config.has_option(project, 'git_depth'):
+            options['depth'] = config.getint(project, 'git_depth')
+        if config.has_option(project, 'git_bare'):
+            options['bare'] = config.getboolean(project, 'git_bare')
+        if config.has_option('main', 'mirror_dir') \
+                and config.has_option(project, 'git_url'):
+            options['mirror'] = get_mirror_path(
+                config, config.get(project, 'git_url'))
+        return options
 
     @classmethod
-    def pull(cls):
-        '''Pull from the repository'''
-        return subprocess.Popen(["git", "pull"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    def clone(cls, url, folder, branch=None, depth=0, bare=False,
+              mirror=None):
+        '''Clone the repository, as a bare and/or shallow clone if asked.
+        With a mirror, the clone is only set up to borrow the objects of the
+        mirror and gets its branch at the next pull'''
+        if mirror:
+            update_mirror(url, mirror)
+            try:
+                repo = pygit2.init_repository(folder, bare=bare)
+                add_alternate(repo.path, mirror)
+                repo.remotes.create('origin', url)
+            except pygit2.GitError, err:
+                raise DgrocException('Could not clone %s: %s' % (url, err))
+            return
 
-    @classmethod
-    def commit_hash(cls, folder):
+        if depth:
+            args = ['clone', '--depth', str(depth)]
+            if branch:
+                args.extend(['--branch', branch])
+            if bare:
+                args.append('--bare')
+            cls.git(args + [url, folder])
+            if bare:
+                # Unlike pygit2, git sets no remote branches up in a bare
+                # clone, the pull looks its branch up there
+                cls.git(['--git-dir', folder, 'config', 'remote.origin.fetch',
+                         '+refs/heads/*:refs/remotes/origin/*'])
+            return
+
+        kwargs = {'bare': bare}
+        if branch:
+            kwargs['checkout_branch'] = branch
+        try:
+            pygit2.clone_repository(url, folder, **kwargs)
+        except pygit2.GitError, err:
+            raise DgrocException('Could not clone %s: %s' % (url, err))
+
+    @staticmethod
+    def git(args):
+        '''Run the git command with the arguments, for what pygit2 cannot
+        do: shallow clones and fetches'''
+        cmd = subprocess.Popen(
+            ["git"] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out = cmd.communicate()
+        if cmd.returncode:
+            raise DgrocException(
+                'git %s failed: %s' % (' '.join(args), out[1].strip()))
+
+    @property
+    def repo(self):
+        '''The pygit2 repository, opened on first use'''
+        if self._repo is None:
+            self._repo = pygit2.Repository(self.folder)
+        return self._repo
+
+    def close(self):
+        '''Release the repository'''
+        self._repo = None
+
+    def pull(self, branch=None, depth=0, bare=False, mirror=None):
+        '''Fetch from the repository and move the local branch to the
+        fetched commit, this never merges anything. With a mirror, only the
+        mirror is fetched, at most once per run'''
+        try:
+            repo = self.repo
+            if mirror:
+                source = update_mirror(repo.remotes['origin'].url, mirror)
+                if add_alternate(repo.path, mirror):
+                    # The clone was made before the mirror, reopen it so
+                    # that it sees the objects of the mirror
+                    self.close()
+                    repo = self.repo
+            else:
+                source = repo
+                if depth:
+                    self.git(['--git-dir', repo.path, 'fetch', '--depth',
+                              str(depth), 'origin'])
+                    # Reopen the clone so that it sees the objects fetched
+                    self.close()
+                    repo = source = self.repo
+                else:
+                    repo.remotes['origin'].fetch()
+            if not branch:
+                # A clone set up from a mirror has no branch yet
+                head = source.head if repo.head_is_unborn else repo.head
+                branch = head.shorthand
+            target = source.lookup_reference(
+                'refs/remotes/origin/%s' % branch).target
+        except (KeyError, TypeError, pygit2.GitError), err:
+            raise DgrocException('Could not fetch branch %s in %s: %s' % (
+                branch, self.folder, err))
+
+        ref_name = 'refs/heads/%s' % branch
+        repo.create_reference(ref_name, target, force=True)
+        repo.set_head(ref_name)
+        if not repo.is_bare:
+            repo.checkout_head(strategy=pygit2.GIT_CHECKOUT_FORCE)
+
+    def repair(self, url, branch=None, depth=0, bare=False, mirror=None):
+        '''Repair a clone that could not be updated: remove the lock files
+        left behind by an interrupted operation and fetch again. The clone
+        is only made again if it cannot be opened at all'''
+        self.close()
+        try:
+            gitdir = pygit2.discover_repository(self.folder)
+        except (KeyError, pygit2.GitError):
+            gitdir = None
+        if not gitdir:
+            if not url:
+                raise DgrocException(
+                    'Cannot re-clone %s without a "git_url"' % self.folder)
+            LOG.info('Re-cloning %s', url)
+            shutil.rmtree(self.folder, ignore_errors=True)
+            self.clone(url, self.folder, branch=branch, depth=depth, bare=bare,
+                       mirror=mirror)
+            self.pull(branch=branch, depth=depth, mirror=mirror)
+            return
+
+        remove_stale_locks(gitdir)
+        if mirror and os.path.isdir(mirror):
+            # Another project may be fetching the mirror
+            with get_mirror_lock(mirror):
+                remove_stale_locks(mirror)
+        self.pull(branch=branch, depth=depth, mirror=mirror)
+
+    def commit_hash(self):
         '''Get the latest commit hash'''
-        repo = pygit2.Repository(folder)
-        commit = repo[repo.head.target]
+        commit = self.repo[self.repo.head.target]
         return commit.oid.hex[:8]
 
+    def remote_url(self):
+        '''Get the url of the repository the local clone comes from'''
+        return self.repo.remotes['origin'].url
+
+    @classmethod
+    def remote_hash(cls, url, branch=None, **options):
+        '''Get the latest commit hash of the remote repository, without
+        fetching anything'''
+        ref = 'refs/heads/%s' % branch if branch else 'HEAD'
+        cmd = subprocess.Popen(
+            ["git", "ls-remote", url, ref],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out = cmd.communicate()
+        if cmd.returncode or not out[0].strip():
+            raise DgrocException(
+                'Could not query %s: %s' % (url, out[1].strip()))
+        return out[0].split()[0][:8]
+
     @classmethod
-    def archive_cmd(cls, project, archive_name):
-        '''Command to generate the archive'''
+    def archive_cmd(cls, project):
+        '''Command writing the archive to stdout'''
         return ["git", "archive", "--format=tar", "--prefix=%s/" % project,
-           "-o%s/%s" % (get_rpm_sourcedir(), archive_name), "HEAD"]
+           "HEAD"]
 
-class MercurialReader(object):
-    '''Alternative version control system to use: hg'''
+    def write_archive(self, project, stream):
+        '''Write the tar archive of HEAD to the stream, walking its tree
+        in-process; this also works on bare repositories'''
+        repo = self.repo
+        commit = repo[repo.head.target]
+        archive = tarfile.open(
+            fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT)
+
+        def _add(name, entry_type, mode, data=None, linkname=''):
+            info = tarfile.TarInfo(name)
+            info.type = entry_type
+            info.mode = mode
+            info.mtime = commit.commit_time
+            info.linkname = linkname
+            if data is not None:
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+            else:
+                archive.addfile(info)
+
+        def _walk(tree, prefix):
+            for entry in tree:
+                name = '%s%s' % (prefix, entry.name)
+                if stat.S_ISDIR(entry.filemode):
+                    _add(name + '/', tarfile.DIRTYPE, 0755)
+                    _walk(repo[entry.id], name + '/')
+                elif stat.S_ISLNK(entry.filemode):
+                    _add(name, tarfile.SYMTYPE, 0777,
+                         linkname=repo[entry.id].data)
+                elif stat.S_ISREG(entry.filemode):
+                    mode = 0755 if entry.filemode & 0111 else 0644
+                    _add(name, tarfile.REGTYPE, mode, data=repo[entry.id].data)
+                else:
+                    # Submodules are archived as empty folders, as git does
+                    _add(name + '/', tarfile.DIRTYPE, 0755)
+
+        _add('%s/' % project, tarfile.DIRTYPE, 0755)
+        _walk(commit.tree, '%s/' % project)
+        archive.close()
+
+
+class MercurialReader(Reader):
+    '''Alternative version control system to use: hg
+
+    All the operations on the local clone go through a single hglib command
+    server, started on first use and kept until the reader is closed'''
     short = 'hg'
+    # The command server can only write archives to a temporary file, the
+    # command streams them
+    archive_backend = 'command'
+
+    def __init__(self, folder):
+        super(MercurialReader, self).__init__(folder)
+        self._client = None
 
     @classmethod
     def init(cls):
@@ -93,25 +592,231 @@ class MercurialReader(object):
     @classmethod
     def clone(cls, url, folder):
         '''Clone the repository'''
-        hglib.clone(url, folder)
-
-    @classmethod
-    def pull(cls):
+        try:
+            hglib.clone(url, folder)
+        except hglib.error.CommandError, err:
+            raise DgrocException('Could not clone %s: %s' % (url, err))
+
+    @property
+    def client(self):
+        '''The command server of the repository, started on first use'''
+        if self._client is None:
+            self._client = hglib.open(self.folder)
+        return self._client
+
+    def close(self):
+        '''Stop the command server'''
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    def pull(self):
         '''Pull from the repository'''
-        return subprocess.Popen(["hg", "pull"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        try:
+            self.client.pull(update=True)
+        except hglib.error.CommandError, err:
+            raise DgrocException(str(err))
 
-    @classmethod
-    def commit_hash(cls, folder):
+    def repair(self, url):
+        '''Repair a clone that could not be updated: roll back an
+        interrupted transaction and pull again'''
+        try:
+            self.client.rawcommand(['recover'])
+        except hglib.error.CommandError:
+            # There was no interrupted transaction
+            pass
+        self.pull()
+
+    def commit_hash(self):
         '''Get the latest commit hash'''
-        repo = hglib.open(folder)
-        commit = commit = repo.log('tip')[0]
-        return commit.node[:12]
+        return self.client.tip().node[:12]
+
+    def remote_url(self):
+        '''Get the url of the repository the local clone comes from'''
+        return self.client.paths('default')
+
+    @classmethod
+    def remote_hash(cls, url, **options):
+        '''Get the latest commit hash of the remote repository, without
+        pulling anything'''
+        cmd = subprocess.Popen(
+            ["hg", "identify", "--id", "--rev", "tip", url],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out = cmd.communicate()
+        if cmd.returncode or not out[0].strip():
+            raise DgrocException(
+                'Could not query %s: %s' % (url, out[1].strip()))
+        return out[0].strip()[:12]
 
     @classmethod
-    def archive_cmd(cls, project, archive_name):
-        '''Command to generate the archive'''
-        return ["hg", "archive", "--type=tar", "--prefix=%s/" % project,
-           "%s/%s" % (get_rpm_sourcedir(), archive_name)]
+    def archive_cmd(cls, project):
+        '''Command writing the archive to stdout'''
+        return ["hg", "archive", "--type=tar", "--prefix=%s/" % project, "-"]
+
+    def write_archive(self, project, stream):
+        '''Write the tar archive of the working directory to the stream
+        through the command server. The server can only write archives to
+        files, so it goes through a temporary file'''
+        handle, path = tempfile.mkstemp(suffix='.tar')
+        os.close(handle)
+        try:
+            self.client.archive(path, prefix='%s/' % project, type='tar')
+            with open(path, 'rb') as archive:
+                shutil.copyfileobj(archive, stream, CHUNK_SIZE)
+        except hglib.error.CommandError, err:
+            raise DgrocException(str(err))
+        finally:
+            os.unlink(path)
+
+
+class ReaderPool(object):
+    ''' The readers of the projects kept open between runs, so that a
+    long-running dgroc re-uses their repositories and command servers.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._readers = {}
+
+    def get(self, config, project, folder):
+        ''' Return the open reader of the project, opening it if needed. '''
+        reader_class = get_reader(config, project)
+        with self._lock:
+            reader = self._readers.get(project)
+            if reader is not None and (
+                    type(reader) is not reader_class
+                    or reader.folder != folder):
+                reader.close()
+                reader = None
+            if reader is None:
+                reader = reader_class(folder)
+                self._readers[project] = reader
+        return reader
+
+    def close(self):
+        ''' Close all the readers. '''
+        with self._lock:
+            for reader in self._readers.values():
+                reader.close()
+            self._readers = {}
+
+
+def get_reader(config, project):
+    ''' Return the reader of the version control system used by the
+    specified project.
+    '''
+    if not config.has_option(project, 'scm') or config.get(project, 'scm') == 'git':
+        return GitReader
+    elif config.get(project, 'scm') == 'hg':
+        return MercurialReader
+    raise DgrocException(
+        'Project "%s" tries to use unknown "scm" option'
+        % project)
+
+
+def get_mirror_path(config, url):
+    ''' Return the path to the bare mirror of the git repository at the
+    url, in the `mirror_dir` of the main section.
+    '''
+    name = url.rstrip('/').split('/')[-1].split(':')[-1]
+    if not name.endswith('.git'):
+        name = '%s.git' % name
+    return os.path.join(
+        os.path.expanduser(config.get('main', 'mirror_dir')),
+        '%s-%s' % (hashlib.sha1(url).hexdigest()[:12], name))
+
+
+def add_alternate(gitdir, mirror):
+    ''' Make the repository in gitdir borrow the objects of the mirror.
+    Returns True if it did not already.
+    '''
+    info = os.path.join(gitdir, 'objects', 'info')
+    objects = os.path.join(os.path.abspath(mirror), 'objects')
+    alternates = os.path.join(info, 'alternates')
+    if os.path.exists(alternates):
+        with open(alternates) as stream:
+            if objects in [row.strip() for row in stream]:
+                return False
+    _makedirs(info)
+    with open(alternates, 'a') as stream:
+        stream.write(objects + '\n')
+    return True
+
+
+def get_mirror_lock(path):
+    ''' Return the lock held while the mirror at the path is updated. '''
+    with MIRROR_LOCK:
+        return _MIRROR_LOCKS.setdefault(path, threading.Lock())
+
+
+def remove_stale_locks(gitdir, max_age=STALE_LOCK_AGE):
+    ''' Remove the lock files left in the git directory by an interrupted
+    operation, the ones not modified in the last ``max_age`` seconds, the
+    others may be held by a git process still running. Git only takes locks
+    on the files at the top of the git directory and on the refs, the object
+    store is not walked.
+    '''
+    limit = time.time() - max_age
+    folders = [gitdir] + [
+        os.path.join(gitdir, name) for name in ('refs', 'logs')]
+    for folder in folders:
+        for root, dirs, filenames in os.walk(folder):
+            if root == gitdir:
+                # The refs and logs are walked on their own
+                del dirs[:]
+            for filename in filenames:
+                if not filename.endswith('.lock'):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    if os.path.getmtime(path) > limit:
+                        LOG.info('Keeping recent lock: %s', filename)
+                        continue
+                    LOG.info('Removing stale lock: %s', filename)
+                    os.unlink(path)
+                except OSError:
+                    # Released in the meantime
+                    pass
+
+
+def update_mirror(url, path):
+    ''' Clone the bare mirror of the git repository at the url, or fetch it,
+    at most once per run however many projects use it.
+    Returns the repository of the mirror.
+    '''
+    with get_mirror_lock(path):
+        try:
+            if path in _MIRRORS_FETCHED:
+                return pygit2.Repository(path)
+            if not os.path.exists(path):
+                LOG.info('Mirroring %s', url)
+                partial = '%s.part' % path
+                shutil.rmtree(partial, ignore_errors=True)
+                _makedirs(os.path.dirname(path))
+                pygit2.clone_repository(url, partial, bare=True)
+                os.rename(partial, path)
+                repo = pygit2.Repository(path)
+            else:
+                LOG.debug('Fetching the mirror of %s', url)
+                repo = pygit2.Repository(path)
+                repo.remotes['origin'].fetch()
+        except (KeyError, pygit2.GitError), err:
+            raise DgrocException(
+                'Could not update the mirror of %s: %s' % (url, err))
+        _MIRRORS_FETCHED.add(path)
+        METRICS.count('mirror_fetches')
+        return repo
+
+
+def init_rpm():
+    ''' Import the rpm bindings, they are only needed by the commands
+    building source rpms.
+    '''
+    global rpm
+    if rpm is None:
+        import rpm as rpm_module
+        rpm = rpm_module
+    return rpm
 
 
 def _get_copr_auth(copr_file):
@@ -155,6 +860,12 @@ def get_arguments():
     '''
     parser = argparse.ArgumentParser(
         description='Daily Git Rebuild On Copr')
+    parser.add_argument(
+        'action', nargs='?', default='build',
+        choices=['build', 'status', 'serve'],
+        help='Build the projects that changed (default), only show which '
+        'projects changed upstream since their last build or keep running '
+        'and build each project on its own schedule')
     parser.add_argument(
         '--config', dest='config', default=DEFAULT_CONFIG,
         help='Configuration file to use for dgroc.')
@@ -170,80 +881,965 @@ def get_arguments():
         '--no-monitoring', dest='monitoring', action='store_false',
         default=True,
         help='Upload the srpm to copr and exit (do not monitor the build)')
+    parser.add_argument(
+        '--jobs', '-j', dest='jobs', type=int, default=1,
+        help='Number of projects to generate the source rpm of in parallel')
+    parser.add_argument(
+        '--upload-jobs', dest='upload_jobs', type=int, default=1,
+        help='Number of source rpms to upload in parallel')
+    parser.add_argument(
+        '--submit-jobs', dest='submit_jobs', type=int, default=2,
+        help='Number of builds to start in copr in parallel')
+    parser.add_argument(
+        '--force', dest='force', action='store_true',
+        default=False,
+        help='Rebuild the projects even if their last commit was already '
+        'built')
+    parser.add_argument(
+        '--reset', dest='reset', action='append', default=[],
+        metavar='PROJECT',
+        help='Forget what was last built for this project (can be used '
+        'several times)')
+    parser.add_argument(
+        '--metrics', dest='metrics', default=None, metavar='FILE',
+        help='Write the timings and counters of the run as JSON to this file')
+    parser.add_argument(
+        '--prometheus', dest='prometheus', default=None, metavar='FILE',
+        help='Write the timings and counters of the run to this file, for the '
+        'textfile collector of the Prometheus node exporter')
+    parser.add_argument(
+        '--profile', dest='profile', default=None, metavar='FOLDER',
+        help='Profile the generation of the source rpm of each project and '
+        'dump the profiles into this folder')
 
     return parser.parse_args()
 
 
-def update_spec(spec_file, commit_hash, archive_name, packager, email, reader):
+class SpecFile(object):
+    ''' A spec file parsed once: its lines and the position of the lines
+    dgroc updates in them.
+    '''
+
+    def __init__(self, path, lines):
+        self.path = path
+        self.lines = lines
+        self.version = None
+        self.releases = []
+        self.sources = []
+        self.changelog = None
+        for index, row in enumerate(lines):
+            if row.startswith('Version:') and self.changelog is None:
+                self.version = row.split('Version:')[1].strip()
+            if row.startswith('Release:'):
+                self.releases.append(index)
+            if row.startswith('Source0:'):
+                self.sources.append(index)
+            if row.startswith('%changelog') and self.changelog is None:
+                self.changelog = index
+
+
+def parse_spec(spec_file):
+    ''' Return the parsed spec file, validated by rpm, from the cache if the
+    file did not change since it was last parsed.
+    '''
+    stat = os.stat(spec_file)
+    key = (stat.st_mtime, stat.st_size)
+    with SPEC_LOCK:
+        cached = _SPEC_CACHE.get(spec_file)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    with RPM_LOCK:
+        rpm.spec(spec_file)
+    with open(spec_file) as stream:
+        spec = SpecFile(spec_file, [row.rstrip() for row in stream])
+    with SPEC_LOCK:
+        _SPEC_CACHE[spec_file] = (key, spec)
+    return spec
+
+
+def write_atomic(filename, rows):
+    ''' Write the rows to the file through a temporary file renamed over
+    it, so that the file is never left half written. A symbolic link is
+    written through, the file it points to being replaced.
+    '''
+    filename = os.path.realpath(filename)
+    folder = os.path.dirname(filename)
+    stream = tempfile.NamedTemporaryFile(
+        'w', dir=folder, prefix='.%s.' % os.path.basename(filename),
+        delete=False)
+    try:
+        with stream:
+            for row in rows:
+                stream.write(row + '\n')
+            stream.flush()
+            os.fsync(stream.fileno())
+        if os.path.exists(filename):
+            shutil.copymode(filename, stream.name)
+        os.rename(stream.name, filename)
+    except Exception:
+        os.unlink(stream.name)
+        raise
+
+
+def parse_changelog_date(header):
+    ''' Return the date, as a timestamp, of the changelog entry starting with
+    the specified header, or None if it cannot be read.
+    '''
+    try:
+        return time.mktime(
+            time.strptime(' '.join(header.split()[1:5]), '%a %b %d %Y'))
+    except ValueError:
+        return None
+
+
+def compact_changelog(rows, keep=None, max_age=None):
+    ''' Remove from the changelog rows the automated ``- Update to <scm>:
+    <hash>`` entries beyond the ``keep`` most recent ones or older than
+    ``max_age`` seconds. Handwritten entries are always kept, and so is the
+    most recent automated entry, as the dates of the entries have no time of
+    day to compare a short ``max_age`` with.
+    Returns the rows kept and the number of entries removed.
+    '''
+    entries = []
+    for row in rows:
+        if row.startswith('* ') or not entries:
+            entries.append([])
+        entries[-1].append(row)
+
+    limit = time.time() - max_age if max_age else None
+    kept = []
+    automated = removed = 0
+    for entry in entries:
+        body = [row.strip() for row in entry[1:] if row.strip()]
+        if entry[0].startswith('* ') and len(body) == 1 \
+                and AUTOMATED_ENTRY.match(body[0]):
+            automated += 1
+            when = parse_changelog_date(entry[0])
+            if (keep is not None and automated > keep) or (
+                    automated > 1 and limit is not None and when is not None
+                    and when < limit):
+                removed += 1
+                continue
+        kept.extend(entry)
+    return kept, removed
+
+
+def get_changelog_limits(config, project):
+    ''' Return the number of automated changelog entries to keep and their
+    maximum age in seconds, set for the project or in the main section, None
+    meaning no limit.
+    '''
+    keep = max_age = None
+    for section in ('main', project):
+        if config.has_option(section, 'changelog_keep'):
+            keep = config.getint(section, 'changelog_keep')
+        if config.has_option(section, 'changelog_max_age'):
+            max_age = parse_duration(
+                config.get(section, 'changelog_max_age'), units='d')
+    if keep is not None and keep < 1:
+        raise DgrocException(
+            'Project "%s" must keep at least one changelog entry' % project)
+    return keep, max_age
+
+
+def get_release(reader, commit_hash):
+    ''' Return the suffix of the release of the build of the specified
+    commit. '''
+    return '%s%s%s' % (
+        date.today().strftime('%Y%m%d'), reader.short, commit_hash)
+
+
+def bump_release(row, reader):
+    ''' Return the release number of the Release line of a spec file,
+    without the suffix of the previous build and incremented. '''
+    rel_num = row.split('ase:')[1].strip().split('%{?dist')[0]
+    rel_list = rel_num.split('.')
+    if reader.short in rel_list[-1]:
+        rel_list = rel_list[:-1]
+    if rel_list[-1].isdigit():
+        rel_list[-1] = str(int(rel_list[-1])+1)
+    return '.'.join(rel_list)
+
+
+def update_spec(spec_file, commit_hash, archive_name, packager, email, reader,
+                output=None, changelog_keep=None, changelog_max_age=None):
     ''' Update the release tag and changelog of the specified spec file
     to work with the specified commit_hash.
+    The spec file is written to ``output`` if specified, instead of being
+    updated in place.
+    The automated changelog entries beyond the ``changelog_keep`` last ones
+    or older than ``changelog_max_age`` seconds are removed in the same pass.
     '''
     LOG.debug('Update spec file: %s', spec_file)
-    release = '%s%s%s' % (date.today().strftime('%Y%m%d'), reader.short, commit_hash)
-    output = []
-    version = None
-    rpm.spec(spec_file)
-    with open(spec_file) as stream:
-        for row in stream:
-            row = row.rstrip()
-            if row.startswith('Version:'):
-                version = row.split('Version:')[1].strip()
-            if row.startswith('Release:'):
-                if commit_hash in row:
-                    raise DgrocException('Spec already up to date')
-                LOG.debug('Release line before: %s', row)
-                rel_num = row.split('ase:')[1].strip().split('%{?dist')[0]
-                rel_list = rel_num.split('.')
-                if reader.short in rel_list[-1]:
-                    rel_list = rel_list[:-1]
-                if rel_list[-1].isdigit():
-                    rel_list[-1] = str(int(rel_list[-1])+1)
-                rel_num = '.'.join(rel_list)
-                LOG.debug('Release number: %s', rel_num)
-                row = 'Release:        %s.%s%%{?dist}' % (rel_num, release)
-                LOG.debug('Release line after: %s', row)
-            if row.startswith('Source0:'):
-                row = 'Source0:        %s' % (archive_name)
-                LOG.debug('Source0 line after: %s', row)
-            if row.startswith('%changelog'):
-                output.append(row)
-                output.append(rpm.expandMacro('* %s %s <%s> - %s-%s.%s' % (
-                    date.today().strftime('%a %b %d %Y'), packager, email,
-                    version, rel_num, release)
-                ))
-                output.append('- Update to %s: %s' % (reader.short, commit_hash))
-                row = ''
-            output.append(row)
+    release = get_release(reader, commit_hash)
+    spec = parse_spec(spec_file)
+    rows = list(spec.lines)
+
+    rel_num = None
+    for index in spec.releases:
+        row = rows[index]
+        LOG.debug('Release line before: %s', row)
+        rel_num = bump_release(row, reader)
+        LOG.debug('Release number: %s', rel_num)
+        rows[index] = 'Release:        %s.%s%%{?dist}' % (rel_num, release)
+        LOG.debug('Release line after: %s', rows[index])
+
+    for index in spec.sources:
+        rows[index] = 'Source0:        %s' % (archive_name)
+        LOG.debug('Source0 line after: %s', rows[index])
+
+    if spec.changelog is not None:
+        with RPM_LOCK:
+            header = rpm.expandMacro('* %s %s <%s> - %s-%s.%s' % (
+                date.today().strftime('%a %b %d %Y'), packager, email,
+                spec.version, rel_num, release)
+            )
+        rows[spec.changelog + 1:spec.changelog + 1] = [
+            header,
+            '- Update to %s: %s' % (reader.short, commit_hash),
+            '',
+        ]
+        if changelog_keep or changelog_max_age:
+            changelog, removed = compact_changelog(
+                rows[spec.changelog + 1:], changelog_keep, changelog_max_age)
+            if removed:
+                rows[spec.changelog + 1:] = changelog
+                LOG.debug('%s changelog entries removed', removed)
+                METRICS.count('changelog_entries_removed', removed)
+
+    output = output or spec_file
+    write_atomic(output, rows)
+    # The file written is known to be valid, no need to parse it again
+    stat = os.stat(output)
+    with SPEC_LOCK:
+        _SPEC_CACHE[output] = (
+            (stat.st_mtime, stat.st_size), SpecFile(output, rows))
+
+    LOG.info('Spec file updated: %s', output)
+    return output
+
+
+def get_rpm_macro(name):
+    ''' Return the value of the specified rpm macro, it is expanded only
+    once via the rpm bindings and then kept for the rest of the run.
+    '''
+    with RPM_LOCK:
+        if name not in _RPM_MACROS:
+            _RPM_MACROS[name] = rpm.expandMacro('%%{%s}' % name)
+        return _RPM_MACROS[name]
 
-    with open(spec_file, 'w') as stream:
-        for row in output:
-            stream.write(row + '\n')
 
-    LOG.info('Spec file updated: %s', spec_file)
+def _makedirs(folder):
+    ''' Create the specified folder if it does not already exist. '''
+    try:
+        os.makedirs(folder)
+    except OSError:
+        # Another worker may have created it in the meantime
+        if not os.path.isdir(folder):
+            raise
 
 
-def get_rpm_sourcedir():
-    ''' Retrieve the _sourcedir for rpm
+class Workspace(object):
+    ''' Private rpm tree of a project, with its own _topdir, _sourcedir and
+    _srcrpmdir so that projects never share or clash on files.
     '''
-    dirname = subprocess.Popen(
-        ['rpm', '-E', '%_sourcedir'],
-        stdout=subprocess.PIPE
-    ).stdout.read()[:-1]
-    return dirname
+
+    # File marking the folders created as workspaces, the only ones that
+    # are ever removed when cleaning the workspaces
+    MARKER = '.dgroc-workspace'
+
+    def __init__(self, root, project):
+        self.project = project
+        self.topdir = os.path.join(root, project)
+        self.sourcedir = os.path.join(self.topdir, 'SOURCES')
+        self.srcrpmdir = os.path.join(self.topdir, 'SRPMS')
+        self.specdir = os.path.join(self.topdir, 'SPECS')
+
+    def prepare(self):
+        ''' Create the folders of the workspace and mark it as used. '''
+        for folder in (self.sourcedir, self.srcrpmdir, self.specdir):
+            _makedirs(folder)
+        marker = os.path.join(self.topdir, self.MARKER)
+        if not os.path.exists(marker):
+            open(marker, 'w').close()
+        os.utime(self.topdir, None)
+        return self
+
+    def rpm_defines(self):
+        ''' Return the arguments making rpmbuild use this workspace. '''
+        return [
+            '--define', '_topdir %s' % self.topdir,
+            '--define', '_sourcedir %s' % self.sourcedir,
+            '--define', '_srcrpmdir %s' % self.srcrpmdir,
+            '--define', '_specdir %s' % self.specdir,
+        ]
+
+    def manifest(self):
+        ''' Return the files staged in the workspace by the previous runs,
+        as a dict associating each of them to its source, size, mtime and
+        digest.
+        '''
+        try:
+            with open(os.path.join(self.topdir, 'staged.json')) as stream:
+                return json.load(stream)
+        except (IOError, ValueError):
+            return {}
+
+    def save_manifest(self, manifest):
+        ''' Record the files staged in the workspace. '''
+        write_atomic(
+            os.path.join(self.topdir, 'staged.json'),
+            [json.dumps(manifest, sort_keys=True)])
+
+    def prune(self, keep):
+        ''' Remove from the workspace the files left over by previous runs,
+        ie: all the files that are not listed in ``keep``.
+        '''
+        keep = set(os.path.abspath(filename) for filename in keep)
+        for folder in (self.sourcedir, self.srcrpmdir):
+            for filename in os.listdir(folder):
+                path = os.path.join(folder, filename)
+                if os.path.abspath(path) not in keep and os.path.isfile(path):
+                    LOG.debug('Removing old file: %s', path)
+                    os.unlink(path)
+
+
+def parse_size(value):
+    ''' Return the number of bytes of a size that may end with ``K``, ``M``
+    or ``G``.
+    '''
+    value = value.strip().upper()
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    factor = 1
+    if value and value[-1] in units:
+        value, factor = value[:-1], units[value[-1]]
+    try:
+        return int(float(value) * factor)
+    except ValueError:
+        raise DgrocException('Invalid size: %s' % value)
+
+
+class SrpmCache(object):
+    ''' Content-addressed cache of the source rpms generated: each source
+    rpm is stored under a digest of everything it was generated from, so
+    it can be re-used as is when none of these inputs changed. The least
+    recently used entries are evicted once the cache exceeds its size.
+    '''
+
+    def __init__(self, folder, max_size=SRPM_CACHE_SIZE):
+        self.folder = folder
+        self.max_size = max_size
+
+    @staticmethod
+    def key(scm, commit_hash, spec, patches, archive_format):
+        ''' Return the digest of the inputs of a source rpm: the commit,
+        the spec file without the lines dgroc generates (release, source
+        and changelog), the patches and the archive format.
+        '''
+        digest = hashlib.sha256()
+        for value in (scm, commit_hash, archive_format):
+            digest.update('%s\0' % value)
+        for index, row in enumerate(spec.lines):
+            if spec.changelog is not None and index > spec.changelog:
+                break
+            if index in spec.releases or index in spec.sources:
+                continue
+            digest.update(row + '\n')
+        for patch in patches:
+            digest.update('\0%s\0%s' % (
+                os.path.basename(patch), file_sha256(patch)))
+        return digest.hexdigest()
+
+    def get(self, key):
+        ''' Return the path to the source rpm stored under the key, or None
+        if there is none.
+        '''
+        entry = os.path.join(self.folder, key)
+        try:
+            srpms = os.listdir(entry)
+        except OSError:
+            return None
+        if len(srpms) != 1:
+            return None
+        # Mark the entry as recently used
+        os.utime(entry, None)
+        return os.path.join(entry, srpms[0])
+
+    def put(self, key, srpm):
+        ''' Store the source rpm under the key and evict the least recently
+        used entries if the cache got too big.
+        '''
+        entry = os.path.join(self.folder, key)
+        if os.path.isdir(entry):
+            return
+        _makedirs(self.folder)
+        partial = tempfile.mkdtemp(prefix='.%s.' % key, dir=self.folder)
+        try:
+            dest = os.path.join(partial, os.path.basename(srpm))
+            try:
+                os.link(srpm, dest)
+            except OSError:
+                shutil.copy2(srpm, dest)
+            os.rename(partial, entry)
+        except OSError, err:
+            # Most likely stored by another worker in the meantime
+            LOG.debug('Could not store %s in the cache: %s', srpm, err)
+            shutil.rmtree(partial, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self):
+        ''' Remove the least recently used entries until the cache fits in
+        its maximum size.
+        '''
+        with SRPM_CACHE_LOCK:
+            entries = []
+            total = 0
+            for key in os.listdir(self.folder):
+                entry = os.path.join(self.folder, key)
+                if key.startswith('.') or not os.path.isdir(entry):
+                    continue
+                size = sum(
+                    os.path.getsize(os.path.join(entry, filename))
+                    for filename in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+                total += size
+            for _, size, entry in sorted(entries):
+                if total <= self.max_size:
+                    break
+                LOG.debug('Evicting from the srpm cache: %s', entry)
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
+
+
+def get_srpm_cache(config):
+    ''' Return the source rpm cache configured in the main section, or None
+    if it is disabled.
+    '''
+    folder = SRPM_CACHE_DIR
+    if config.has_option('main', 'srpm_cache_dir'):
+        folder = os.path.expanduser(config.get('main', 'srpm_cache_dir'))
+    max_size = SRPM_CACHE_SIZE
+    if config.has_option('main', 'srpm_cache_size'):
+        max_size = parse_size(config.get('main', 'srpm_cache_size'))
+    if not max_size:
+        return None
+    return SrpmCache(folder, max_size)
+
+
+def get_inputs(config, project, scm, commit_hash):
+    ''' Return the digest of the inputs of the source rpm of the project at
+    the specified commit, see SrpmCache.key(), or None for the projects
+    built from scm, whose source rpm is not generated locally.
+    '''
+    if get_build_method(config, project) != 'srpm':
+        return None
+    spec_file = config.get(project, 'spec_file')
+    if '~' in spec_file:
+        spec_file = os.path.expanduser(spec_file)
+    return SrpmCache.key(
+        scm, commit_hash, parse_spec(spec_file),
+        get_patches(config, project), get_archive_format(config, project))
+
+
+class BuildState(object):
+    ''' Persistent record, stored in a SQLite database, of what was last
+    built for each project and scm: the commit, the digest of the inputs
+    of the source rpm, the source rpm, the copr build id and the result of
+    that build.
+    '''
+
+    # Results for which the source rpm, or the source of a build from scm,
+    # still has to be sent to copr
+    UNSUBMITTED = ('srpm', 'scm', 'upload-failed', 'submit-failed')
+
+    def __init__(self, path, readonly=False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        if readonly:
+            # Do not create anything, a missing store is an empty one
+            if os.path.exists(path):
+                self._conn = sqlite3.connect(
+                    path, timeout=60, check_same_thread=False)
+                self._conn.row_factory = sqlite3.Row
+            return
+        _makedirs(os.path.dirname(os.path.abspath(path)))
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS uploads ('
+                '  sha256 TEXT NOT NULL,'
+                '  copr TEXT NOT NULL,'
+                '  srpm_url TEXT,'
+                '  build_id TEXT,'
+                '  updated REAL,'
+                '  PRIMARY KEY (sha256, copr))')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS inflight ('
+                '  project TEXT NOT NULL,'
+                '  chroot TEXT NOT NULL,'
+                '  build_id TEXT NOT NULL,'
+                '  updated REAL,'
+                '  PRIMARY KEY (project, chroot, build_id))')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS durations ('
+                '  project TEXT NOT NULL,'
+                '  stage TEXT NOT NULL,'
+                '  seconds REAL,'
+                '  updated REAL,'
+                '  PRIMARY KEY (project, stage))')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS builds ('
+                '  project TEXT NOT NULL,'
+                '  scm TEXT NOT NULL,'
+                '  commit_hash TEXT,'
+                '  inputs TEXT,'
+                '  srpm TEXT,'
+                '  build_id TEXT,'
+                '  result TEXT,'
+                '  updated REAL,'
+                '  PRIMARY KEY (project, scm))')
+            try:
+                self._conn.execute(
+                    'ALTER TABLE builds ADD COLUMN inputs TEXT')
+            except sqlite3.OperationalError:
+                # The column is already there
+                pass
+
+    def get(self, project, scm):
+        ''' Return the last build recorded for the project as a dict, or
+        None if it was never built.
+        '''
+        if self._conn is None:
+            return None
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    'SELECT * FROM builds WHERE project = ? AND scm = ?',
+                    (project, scm)).fetchone()
+            except sqlite3.OperationalError:
+                # Read-only access to a store that was never initialized
+                row = None
+        if row is None:
+            return None
+        return dict(zip(row.keys(), row))
+
+    def update(self, project, scm, **fields):
+        ''' Record the specified fields for the project. '''
+        fields['updated'] = time.time()
+        columns = sorted(fields)
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR IGNORE INTO builds (project, scm) VALUES (?, ?)',
+                (project, scm))
+            self._conn.execute(
+                'UPDATE builds SET %s WHERE project = ? AND scm = ?' % ', '.join(
+                    '%s = ?' % column for column in columns),
+                [fields[column] for column in columns] + [project, scm])
+
+    def set_result(self, build_id, result):
+        ''' Record the result of the specified copr build, which is then
+        no longer in flight.
+        '''
+        with self._lock, self._conn:
+            self._conn.execute(
+                'UPDATE builds SET result = ?, updated = ? WHERE build_id = ?',
+                (result, time.time(), str(build_id)))
+            self._conn.execute(
+                'DELETE FROM inflight WHERE build_id = ?', (str(build_id),))
+
+    def inflight(self, project):
+        ''' Return a dict associating the identifier of the builds of the
+        project that are in flight to the list of their chroots.
+        '''
+        if self._conn is None:
+            return {}
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT build_id, chroot FROM inflight WHERE project = ?',
+                (project,)).fetchall()
+        builds = {}
+        for row in rows:
+            builds.setdefault(row['build_id'], []).append(row['chroot'])
+        return builds
+
+    def record_inflight(self, project, build_id, chroots):
+        ''' Record that the build of the project runs in these chroots. '''
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO inflight '
+                '(project, chroot, build_id, updated) VALUES (?, ?, ?, ?)',
+                [(project, chroot, str(build_id), now) for chroot in chroots])
+
+    def clear_inflight(self, build_id):
+        ''' Forget that the build is in flight. '''
+        with self._lock, self._conn:
+            self._conn.execute(
+                'DELETE FROM inflight WHERE build_id = ?', (str(build_id),))
+
+    def submitted_at(self, build_id):
+        ''' Return when the specified build, not finished yet, was started
+        in copr, or None if it is unknown. '''
+        if self._conn is None:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT updated FROM builds WHERE build_id = ? AND result = ?',
+                (str(build_id), 'submitted')).fetchone()
+        return row[0] if row else None
+
+    def record_duration(self, project, stage, seconds):
+        ''' Record how long the stage took for the project, averaged with
+        the durations of the previous runs. '''
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                'SELECT seconds FROM durations WHERE project = ? AND stage = ?',
+                (project, stage)).fetchone()
+            if row is not None and row[0] is not None:
+                seconds = row[0] + HISTORY_WEIGHT * (seconds - row[0])
+            self._conn.execute(
+                'INSERT OR REPLACE INTO durations '
+                '(project, stage, seconds, updated) VALUES (?, ?, ?, ?)',
+                (project, stage, seconds, time.time()))
+
+    def durations(self):
+        ''' Return a dict associating each project to a dict of the average
+        duration of its stages, ``generate`` and ``build``. '''
+        if self._conn is None:
+            return {}
+        with self._lock:
+            try:
+                rows = self._conn.execute(
+                    'SELECT project, stage, seconds FROM durations').fetchall()
+            except sqlite3.OperationalError:
+                # Read-only access to a store that was never initialized
+                rows = []
+        durations = {}
+        for row in rows:
+            durations.setdefault(row['project'], {})[row['stage']] = \
+                row['seconds']
+        return durations
+
+    def find_upload(self, sha256, copr=''):
+        ''' Return the url and the build id recorded for the source rpm
+        with the specified checksum, for builds: in the specified copr.
+        Returns None if it was never uploaded.
+        '''
+        if self._conn is None:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT srpm_url, build_id FROM uploads '
+                'WHERE sha256 = ? AND copr = ?', (sha256, copr)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(row.keys(), row))
+
+    def forget_uploads(self, srpm_urls):
+        ''' Forget the source rpms uploaded at the specified urls. '''
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'DELETE FROM uploads WHERE srpm_url = ?',
+                [(srpm_url,) for srpm_url in srpm_urls])
+
+    def record_upload(self, sha256, copr='', srpm_url=None, build_id=None):
+        ''' Record that the source rpm with the specified checksum was
+        uploaded to the url or built in the copr.
+        '''
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO uploads '
+                '(sha256, copr, srpm_url, build_id, updated) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (sha256, copr, srpm_url, build_id, time.time()))
+
+    def unfinished(self):
+        ''' Return a dict associating the identifier of the builds started
+        in copr, whose result is not known yet, to their project.
+        '''
+        if self._conn is None:
+            return {}
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT build_id, project FROM builds '
+                'WHERE result = ? AND build_id IS NOT NULL',
+                ('submitted',)).fetchall()
+        return dict((row['build_id'], row['project']) for row in rows)
+
+    def reset(self, project):
+        ''' Forget what was last built for the project. '''
+        with self._lock, self._conn:
+            self._conn.execute(
+                'DELETE FROM builds WHERE project = ?', (project,))
+
+    def close(self):
+        ''' Close the connection to the database. '''
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+
+
+def get_archive_format(config, project):
+    ''' Return the format of the source archive of the specified project,
+    set for the project or in the main section.
+    '''
+    archive_format = 'tar'
+    for section in (project, 'main'):
+        if config.has_option(section, 'archive_format'):
+            archive_format = config.get(section, 'archive_format')
+            break
+    if archive_format not in ARCHIVE_FORMATS:
+        raise DgrocException(
+            'Project "%s" uses an unknown "archive_format": %s, valid formats '
+            'are: %s' % (
+                project, archive_format, ', '.join(sorted(ARCHIVE_FORMATS))))
+    return archive_format
+
+
+def make_archive(config, reader, project, commit_hash, sourcedir):
+    ''' Generate the source archive of the project's commit into the
+    sourcedir, streaming it through the compressor of the archive format.
+    The archive is written in-process or by a command depending on the
+    `archive_backend` option, which defaults to the backend of the reader.
+    The archive is only written under its final name once complete, so an
+    archive already present for the same commit and format is re-used.
+    Returns the name of the archive.
+    '''
+    archive_format = get_archive_format(config, project)
+    archive_name = '%s-%s.%s' % (project, commit_hash, archive_format)
+    dest = os.path.join(sourcedir, archive_name)
+    if os.path.exists(dest):
+        LOG.info('Re-using archive: %s', archive_name)
+        return archive_name
+
+    threads = '0'
+    if config.has_option('main', 'archive_threads'):
+        threads = config.get('main', 'archive_threads')
+
+    backend = reader.archive_backend
+    for section in (project, 'main'):
+        if config.has_option(section, 'archive_backend'):
+            backend = config.get(section, 'archive_backend')
+            break
+    in_process = backend != 'command' and hasattr(reader, 'write_archive')
+
+    compressor = ARCHIVE_FORMATS[archive_format]
+    partial = '%s.part' % dest
+    errors = tempfile.TemporaryFile()
+    processes = []
+    failure = None
+    with open(partial, 'wb') as stream:
+        output = stream
+        if compressor is not None:
+            compressor = [arg % {'threads': threads} for arg in compressor]
+            LOG.debug('Compressing with: %s', ' '.join(compressor))
+            compress = subprocess.Popen(
+                compressor, stdin=subprocess.PIPE, stdout=stream,
+                stderr=errors)
+            output = compress.stdin
+            processes.append(compress)
+        try:
+            if in_process:
+                LOG.debug('Generating archive in-process')
+                reader.write_archive(project, output)
+            else:
+                cmd = reader.archive_cmd(project)
+                LOG.debug('Command to generate archive: %s', ' '.join(cmd))
+                processes.insert(0, subprocess.Popen(
+                    cmd, cwd=reader.folder, stdout=output, stderr=errors))
+        except Exception, err:
+            failure = err
+        finally:
+            # Only the compressor reads the archive
+            if compressor is not None:
+                output.close()
+        failed = [process.wait() for process in processes]
+
+    errors.seek(0)
+    output = errors.read()
+    errors.close()
+    if failure or any(failed):
+        os.unlink(partial)
+        raise DgrocException(
+            'Could not generate the archive %s:\n%s' % (
+                archive_name, failure or output))
+    os.rename(partial, dest)
+    LOG.info('Archive generated: %s', archive_name)
+    METRICS.count('archive_bytes', os.path.getsize(dest), project=project)
+    return archive_name
+
+
+def get_patches(config, project):
+    ''' Return the patch files of the project, expanding the globs listed in
+    its `patch_files` option.
+    '''
+    patches = []
+    if not config.has_option(project, 'patch_files'):
+        return patches
+    candidates = config.get(project, 'patch_files').split(',')
+    candidates = [candidate.strip() for candidate in candidates]
+    for candidate in candidates:
+        candidate = os.path.expanduser(candidate)
+        with GLOB_LOCK:
+            expanded = _GLOB_CACHE.get(candidate)
+        if expanded is None:
+            LOG.debug('Expanding path: %s', candidate)
+            expanded = sorted(glob.glob(candidate))
+            with GLOB_LOCK:
+                _GLOB_CACHE[candidate] = expanded
+        if not expanded:
+            LOG.info('Could not expand path: `%s`', candidate)
+        patches.extend(expanded)
+    return patches
+
+
+def reset_run_caches():
+    ''' Forget the globs expanded and the mirrors fetched, so that they are
+    expanded and fetched again by the next run.
+    '''
+    with GLOB_LOCK:
+        _GLOB_CACHE.clear()
+    with MIRROR_LOCK:
+        _MIRRORS_FETCHED.clear()
+
+
+def reflink_file(source, dest):
+    ''' Make ``dest`` a copy-on-write clone of ``source``, raises IOError
+    if the filesystem does not support it.
+    '''
+    try:
+        with open(source, 'rb') as src:
+            with open(dest, 'wb') as dst:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+    except IOError:
+        if os.path.exists(dest):
+            os.unlink(dest)
+        raise
+
+
+def link_file(source, dest):
+    ''' Make ``dest`` a hardlink to ``source`` or, if the filesystem does
+    not allow it, a reflink or a copy of it.
+    Returns how the file was linked: ``hardlink``, ``reflink`` or ``copy``.
+    '''
+    if os.path.lexists(dest):
+        os.unlink(dest)
+    try:
+        os.link(source, dest)
+        return 'hardlink'
+    except OSError:
+        pass
+    try:
+        reflink_file(source, dest)
+        shutil.copystat(source, dest)
+        return 'reflink'
+    except IOError:
+        shutil.copy2(source, dest)
+        return 'copy'
+
+
+def stage_file(source, dest, manifest):
+    ''' Stage the source file as ``dest``, unless what was staged there is
+    the same file or its size, mtime or digest, as recorded in the manifest,
+    show it did not change.
+    Returns True if the file was staged, False if it was up to date.
+    '''
+    stat = os.stat(source)
+    if os.path.exists(dest) and os.path.samefile(source, dest):
+        return False
+    entry = manifest.get(dest)
+    if entry and entry['source'] == source and os.path.exists(dest) \
+            and os.path.getsize(dest) == stat.st_size == entry['size']:
+        if entry['mtime'] == stat.st_mtime:
+            return False
+        digest = file_sha256(source)
+        if digest == entry['sha256']:
+            entry['mtime'] = stat.st_mtime
+            return False
+
+    method = link_file(source, dest)
+    LOG.debug('Staged %s to %s (%s)', source, dest, method)
+    METRICS.count('staged_%s' % method)
+    manifest[dest] = {
+        'source': source,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha256': None if method == 'hardlink' else file_sha256(dest),
+    }
+    return True
+
+
+def get_copr_name(config, project):
+    ''' Return the name of the copr in which the project is built. '''
+    if config.has_option(project, 'copr'):
+        return config.get(project, 'copr')
+    return project
+
+
+def get_scm(config, project):
+    ''' Return the name of the scm used by the specified project. '''
+    if config.has_option(project, 'scm'):
+        return config.get(project, 'scm')
+    return 'git'
+
+
+def get_build_state(config, readonly=False):
+    ''' Return the build state store configured in the main section. '''
+    path = DEFAULT_STATE
+    if config.has_option('main', 'state_file'):
+        path = os.path.expanduser(config.get('main', 'state_file'))
+    return BuildState(path, readonly=readonly)
+
+
+def get_workspace_root(config):
+    ''' Return the folder in which the project workspaces are created. '''
+    if config.has_option('main', 'workspace_dir'):
+        return os.path.expanduser(config.get('main', 'workspace_dir'))
+    return os.path.join(get_rpm_macro('_topdir'), 'dgroc')
+
+
+def get_workspace(config, project):
+    ''' Return the prepared workspace of the specified project. '''
+    return Workspace(get_workspace_root(config), project).prepare()
+
+
+def clean_workspaces(config):
+    ''' Remove the workspaces of the projects that are no longer in the
+    configuration file and the ones that have not been used in the last
+    ``workspace_max_age`` days. The folders that are not workspaces, see
+    Workspace.MARKER, are left alone.
+    '''
+    root = get_workspace_root(config)
+    if not os.path.isdir(root):
+        return
+    max_age = WORKSPACE_MAX_AGE
+    if config.has_option('main', 'workspace_max_age'):
+        max_age = config.getint('main', 'workspace_max_age')
+    limit = time.time() - max_age * 24 * 3600
+
+    for project in os.listdir(root):
+        path = os.path.join(root, project)
+        if not os.path.isfile(os.path.join(path, Workspace.MARKER)):
+            continue
+        if config.has_section(project) and os.path.getmtime(path) > limit:
+            continue
+        LOG.info('Removing old workspace: %s', path)
+        shutil.rmtree(path, ignore_errors=True)
 
 
-def generate_new_srpm(config, project, first=True):
+def generate_new_srpm(config, project, state=None, force=False, readers=None):
     ''' For a given project in the configuration file generate a new srpm
     if it is possible.
+    If a build state store is given, nothing is done for a commit that was
+    already built, unless ``force`` is True.
+    The reader of the project is taken from the ``readers`` pool if one is
+    given, otherwise it is opened for this call only.
     '''
-    if not config.has_option(project, 'scm') or config.get(project, 'scm') == 'git':
-        reader = GitReader
-    elif config.get(project, 'scm') == 'hg':
-        reader = MercurialReader
-    else:
-        raise DgrocException(
-            'Project "%s" tries to use unknown "scm" option'
-            % project)
+    reader = get_reader(config, project)
     reader.init()
     LOG.debug('Generating new source rpm for project: %s', project)
     if not config.has_option(project, '%s_folder' % reader.short):
@@ -267,98 +1863,145 @@ def generate_new_srpm(config, project, first=True):
     if '~' in git_folder:
         git_folder = os.path.expanduser(git_folder)
 
-    if not os.path.exists(git_folder):
+    git_url = None
+    if config.has_option(project, '%s_url' % reader.short):
         git_url = config.get(project, '%s_url' % reader.short)
+    options = reader.options(config, project)
+
+    if not os.path.exists(git_folder):
         LOG.info('Cloning %s', git_url)
-        reader.clone(git_url, git_folder)
+        with METRICS.timer('clone', project):
+            reader.clone(git_url, git_folder, **options)
 
+    if readers is not None:
+        reader = readers.get(config, project, git_folder)
+    else:
+        reader = reader(git_folder)
+    try:
+        return _generate_srpm(
+            config, project, reader, git_url, options, state=state,
+            force=force)
+    finally:
+        if readers is None:
+            reader.close()
+
+
+def _generate_srpm(config, project, reader, git_url, options, state=None,
+                   force=False):
+    ''' Update the clone the reader is opened on and generate the new srpm
+    of the project from it, see generate_new_srpm().
+    '''
     # git pull
-    cwd = os.getcwd()
-    os.chdir(git_folder)
-    pull = reader.pull()
-    out = pull.communicate()
-    os.chdir(cwd)
-    if pull.returncode:
-        LOG.info('Strange result of the %s pull:\n%s', reader.short, out[0])
-        if first:
-            LOG.info('Gonna try to re-clone the project')
-            shutil.rmtree(git_folder)
-            generate_new_srpm(config, project, first=False)
-        return
+    with METRICS.timer('pull', project):
+        try:
+            reader.pull(**options)
+        except DgrocException, err:
+            LOG.info('Strange result of the %s pull:\n%s', reader.short, err)
+            LOG.info('Gonna try to repair the clone')
+            try:
+                reader.repair(git_url, **options)
+            except DgrocException, err:
+                LOG.info('Could not repair the clone: %s', err)
+                return
 
     # Retrieve last commit
-    commit_hash = reader.commit_hash(git_folder)
+    commit_hash = reader.commit_hash()
     LOG.info('Last commit: %s', commit_hash)
 
-    # Check if commit changed
-    changed = False
-    if not config.has_option(project, '%s_hash' % reader.short):
-        config.set(project, '%s_hash  % reader.short', commit_hash)
-        changed = True
-    elif config.get(project, '%s_hash' % reader.short) == commit_hash:
-        changed = False
-    elif config.get(project, '%s_hash  % reader.short') != commit_hash:
-        changed = True
-
-    if not changed:
-        return
-
-    # Build sources
-    cwd = os.getcwd()
-    os.chdir(git_folder)
-    archive_name = "%s-%s.tar" % (project, commit_hash)
-    cmd = reader.archive_cmd(project, archive_name)
-    LOG.debug('Command to generate archive: %s', ' '.join(cmd))
-    pull = subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
-    out = pull.communicate()
-    os.chdir(cwd)
-
-    # Update spec file
     spec_file = config.get(project, 'spec_file')
     if '~' in spec_file:
         spec_file = os.path.expanduser(spec_file)
+    patches = get_patches(config, project)
+    key = SrpmCache.key(
+        reader.short, commit_hash, parse_spec(spec_file), patches,
+        get_archive_format(config, project))
+
+    # Check if commit, spec file or patches changed, the builds recorded
+    # without their inputs only have their commit compared
+    last = None
+    if state is not None:
+        last = state.get(project, reader.short)
+    if last and last['commit_hash'] == commit_hash \
+            and last['inputs'] in (None, key) and not force:
+        if last['result'] not in BuildState.UNSUBMITTED:
+            LOG.info('Commit %s already built', commit_hash)
+            return
+        if last['srpm'] and os.path.exists(last['srpm']):
+            LOG.info('Re-using source rpm not yet built: %s', last['srpm'])
+            return last['srpm']
+
+    workspace = get_workspace(config, project)
+    sourcedir = workspace.sourcedir
+
+    # Re-use the source rpm generated from the same inputs, if any
+    cache = get_srpm_cache(config)
+    if cache is not None:
+        cached = cache.get(key)
+        if cached:
+            srpm = os.path.join(workspace.srcrpmdir, os.path.basename(cached))
+            link_file(cached, srpm)
+            LOG.info('Re-using cached source rpm: %s', srpm)
+            METRICS.count('srpm_cache_hits', project=project)
+            if state is not None:
+                state.update(
+                    project, reader.short, commit_hash=commit_hash,
+                    inputs=key, srpm=srpm, build_id=None, result='srpm')
+            return srpm
+        METRICS.count('srpm_cache_misses', project=project)
 
-    update_spec(
-        spec_file,
-        commit_hash,
-        archive_name,
-        config.get('main', 'username'),
-        config.get('main', 'email'),
-        reader)
-
-    # Copy patches
-    if config.has_option(project, 'patch_files'):
-        LOG.info('Copying patches')
-        candidates = config.get(project, 'patch_files').split(',')
-        candidates = [candidate.strip() for candidate in candidates]
-        for candidate in candidates:
-            LOG.debug('Expanding path: %s', candidate)
-            candidate = os.path.expanduser(candidate)
-            patches = glob.glob(candidate)
-            if not patches:
-                LOG.info('Could not expand path: `%s`', candidate)
+    # Build sources
+    with METRICS.timer('archive', project):
+        archive_name = make_archive(
+            config, reader, project, commit_hash, sourcedir)
+
+    # Update spec file
+    output = None
+    if config.has_option(project, 'spec_template') \
+            and config.getboolean(project, 'spec_template'):
+        # Render the spec file into the workspace, leave the original as is
+        output = os.path.join(workspace.specdir, os.path.basename(spec_file))
+
+    changelog_keep, changelog_max_age = get_changelog_limits(config, project)
+    with METRICS.timer('spec', project):
+        spec_file = update_spec(
+            spec_file,
+            commit_hash,
+            archive_name,
+            config.get('main', 'username'),
+            config.get('main', 'email'),
+            reader,
+            output=output,
+            changelog_keep=changelog_keep,
+            changelog_max_age=changelog_max_age)
+
+    # Stage patches
+    staged = [os.path.join(sourcedir, archive_name)]
+    if patches:
+        with METRICS.timer('patches', project):
+            manifest = workspace.manifest()
+            count = 0
             for patch in patches:
-                filename = os.path.basename(patch)
-                dest = os.path.join(get_rpm_sourcedir(), filename)
-                LOG.debug('Copying from %s, to %s', patch, dest)
-                shutil.copy(
-                    patch,
-                    dest
-                )
-
-    # Generate SRPM
-    env = os.environ
+                dest = os.path.join(sourcedir, os.path.basename(patch))
+                if stage_file(patch, dest, manifest):
+                    count += 1
+                staged.append(dest)
+            workspace.save_manifest(dict(
+                (dest, manifest[dest]) for dest in staged if dest in manifest))
+            LOG.info('%s patches staged, %s up to date', count,
+                     len(patches) - count)
+
+    # Generate SRPM, rpmbuild overwrites files in place so the old source
+    # rpms, which may be hardlinked to the cache, are removed first
+    workspace.prune(staged)
+    env = dict(os.environ)
     env['LANG'] = 'C'
-    build = subprocess.Popen(
-        ["rpmbuild", "-bs", spec_file],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        env=env)
-    out = build.communicate()
-    os.chdir(cwd)
+    with METRICS.timer('rpmbuild', project):
+        build = subprocess.Popen(
+            ["rpmbuild"] + workspace.rpm_defines() + ["-bs", spec_file],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            env=env)
+        out = build.communicate()
     if build.returncode:
         LOG.info(
             'Strange result of the rpmbuild -bs:\n  stdout:%s\n  stderr:%s',
@@ -368,67 +2011,798 @@ def generate_new_srpm(config, project, first=True):
         return
     srpm = out[0].split('Wrote:')[1].strip()
     LOG.info('SRPM built: %s', srpm)
+    METRICS.count('srpms_generated', project=project)
+    METRICS.count('srpm_bytes', os.path.getsize(srpm), project=project)
+    if cache is not None:
+        cache.put(key, srpm)
+    if state is not None:
+        state.update(
+            project, reader.short, commit_hash=commit_hash, inputs=key,
+            srpm=srpm, build_id=None, result='srpm')
 
     return srpm
 
 
-def upload_srpms(config, srpms):
-    ''' Using the information provided in the configuration file,
-    upload the src.rpm generated somewhere.
+def get_build_method(config, project):
+    ''' Return how the project is built: from a source rpm generated
+    locally (``srpm``) or by copr from its repository (``scm``). '''
+    method = 'srpm'
+    if config.has_option(project, 'build_method'):
+        method = config.get(project, 'build_method')
+    if method not in BUILD_METHODS:
+        raise DgrocException(
+            'Project "%s" uses an unknown "build_method": %s, valid methods '
+            'are: %s' % (project, method, ', '.join(BUILD_METHODS)))
+    return method
+
+
+def prepare_scm_build(config, project, state=None, force=False):
+    ''' Find the last commit of the project's remote repository and return
+    what copr needs to build it from there: the ``clone_url``, the
+    ``committish``, the ``subdirectory`` and the ``spec`` in it, see
+    submit_scm_build(). Nothing is cloned, archived nor built locally, only
+    the release of the build is rendered from the local spec file, if any.
+    If a build state store is given, nothing is done for a commit that was
+    already built, unless ``force`` is True.
     '''
-    if not config.has_option('main', 'upload_command'):
-        LOG.info(
-            'No `upload_command` specified in the `main` section of the '
-            'configuration file. Attempting to build by direct upload.')
+    reader = get_reader(config, project)
+    if reader.short != 'git':
+        raise DgrocException(
+            'Project "%s" cannot be built from scm: copr only builds git '
+            'repositories' % project)
+    if not config.has_option(project, 'git_url'):
+        raise DgrocException(
+            'Project "%s" does not specify a "git_url" option' % project)
+    if config.has_option(project, 'scm_spec'):
+        spec = config.get(project, 'scm_spec')
+    elif config.has_option(project, 'spec_file'):
+        spec = os.path.basename(config.get(project, 'spec_file'))
+    else:
+        raise DgrocException(
+            'Project "%s" specifies neither a "scm_spec" nor a "spec_file" '
+            'option' % project)
+    url = config.get(project, 'git_url')
+
+    reader.init()
+    with METRICS.timer('check', project):
+        commit_hash = reader.remote_hash(
+            url, **reader.options(config, project))
+    LOG.info('Last commit: %s', commit_hash)
+
+    last = None
+    if state is not None:
+        last = state.get(project, reader.short)
+    if last and last['commit_hash'] == commit_hash and not force \
+            and last['result'] not in BuildState.UNSUBMITTED:
+        LOG.info('Commit %s already built', commit_hash)
         return
 
-    upload_command = config.get('main', 'upload_command')
+    release = get_release(reader, commit_hash)
+    if config.has_option(project, 'spec_file'):
+        spec_file = os.path.expanduser(config.get(project, 'spec_file'))
+        with METRICS.timer('spec', project):
+            parsed = parse_spec(spec_file)
+            if parsed.releases:
+                release = '%s.%s' % (bump_release(
+                    parsed.lines[parsed.releases[0]], reader), release)
+            release = '%s-%s' % (parsed.version, release)
+    LOG.info('Building %s from scm', release)
+    if state is not None:
+        state.update(
+            project, reader.short, commit_hash=commit_hash, srpm=None,
+            build_id=None, result='scm')
+
+    subdirectory = ''
+    if config.has_option(project, 'scm_subdirectory'):
+        subdirectory = config.get(project, 'scm_subdirectory')
+    return {
+        'clone_url': url,
+        'committish': commit_hash,
+        'subdirectory': subdirectory,
+        'spec': spec,
+        'release': release,
+    }
+
+
+def check_remote(config, project, state=None):
+    ''' Ask the remote repository of the project for its latest commit,
+    without pulling anything, and compare it, along with the spec file and
+    the patches, with the last commit built.
+    Returns a dict with the ``scm``, the ``remote`` and the ``built``
+    commit hashes, the ``result`` of the last build and whether the
+    project ``changed``.
+    '''
+    reader = get_reader(config, project)
+    reader.init()
+    if config.has_option(project, '%s_url' % reader.short):
+        url = config.get(project, '%s_url' % reader.short)
+    elif config.has_option(project, '%s_folder' % reader.short):
+        with reader(os.path.expanduser(
+                config.get(project, '%s_folder' % reader.short))) as local:
+            url = local.remote_url()
+    else:
+        raise DgrocException(
+            'Project "%s" specifies neither a "%s_url" nor a "%s_folder" '
+            'option' % (project, reader.short, reader.short))
+
+    with METRICS.timer('check', project):
+        remote = reader.remote_hash(url, **reader.options(config, project))
+    LOG.debug('%s: remote commit %s', project, remote)
+
+    last = None
+    if state is not None:
+        last = state.get(project, reader.short)
+    built = last['commit_hash'] if last else None
+    changed = remote != built
+    if not changed and last and last['inputs'] is not None:
+        changed = get_inputs(config, project, reader.short, remote) \
+            != last['inputs']
+    return {
+        'scm': reader.short,
+        'remote': remote,
+        'built': built,
+        'result': last['result'] if last else None,
+        'changed': changed,
+    }
+
+
+def check_remotes(config, projects, state=None):
+    ''' Concurrently check the remote repository of each of the specified
+    projects, see check_remote().
+    Projects whose remote could not be checked are left out.
+    '''
+    jobs = CHECK_JOBS
+    if config.has_option('main', 'check_jobs'):
+        jobs = config.getint('main', 'check_jobs')
+    return run_in_threads(
+        lambda project: check_remote(config, project, state=state),
+        projects, jobs=jobs)
 
-    for srpm in srpms:
-        LOG.debug('Uploading source rpm: %s', srpm)
-        cmd = upload_command % srpm
-        outcode = subprocess.call(cmd, shell=True)
-        if outcode:
-            LOG.info('Strange result with the command: `%s`', cmd)
 
+def show_status(config):
+    ''' Print, for each project, the last commit built and the latest
+    commit of its remote repository. Nothing is pulled nor written.
+    '''
+    state = get_build_state(config, readonly=True)
+    projects = [
+        project for project in config.sections() if project != 'main']
+    status = check_remotes(config, projects, state=state)
+    state.close()
+
+    for project in projects:
+        info = status.get(project)
+        if info is None:
+            print('%-30s unknown' % project)
+            continue
+        print('%-30s %-3s built: %-12s remote: %-12s %s (%s)' % (
+            project, info['scm'], info['built'] or '-', info['remote'],
+            'changed' if info['changed'] else 'up to date',
+            info['result'] or 'never built'))
 
-def get_project_id(copr_url, username, copr, insecure=False):
-    ''' Given username and COPR name, find its internal id. '''
-    try:
-        response = requests.get('%s/api_2/projects' % copr_url,
-                                params=dict(owner=username, name=copr),
-                                verify=not insecure)
-        project = response.json()['projects'][0]
-        return project['project']['id']
-    except (ValueError, KeyError, IndexError):
-        raise DgrocException(
-            'Failed to find project id of %s/%s' % (username, copr))
 
+def run_in_threads(function, items, jobs=1):
+    ''' Call ``function`` on each of the items using up to ``jobs`` worker
+    threads, each worker being named after the item it processes.
+    Returns a dict associating each item to the value returned, an item
+    failing is logged and left out without affecting the others.
+    '''
+    results = {}
+    lock = threading.Lock()
+    queue = list(items)
+
+    def _process(item):
+        ''' Call the function on a single item. '''
+        try:
+            result = function(item)
+        except DgrocException, err:
+            LOG.info('%s: %s', item, err)
+            return
+        except Exception:
+            if jobs <= 1:
+                raise
+            LOG.exception('%s: unexpected error', item)
+            return
+        with lock:
+            results[item] = result
+
+    def _worker():
+        ''' Process items until there are none left. '''
+        thread = threading.current_thread()
+        while True:
+            with lock:
+                if not queue:
+                    return
+                item = queue.pop(0)
+            thread.name = item
+            _process(item)
+
+    if jobs <= 1:
+        for item in queue:
+            _process(item)
+        return results
+
+    workers = []
+    for _ in range(min(jobs, len(queue))):
+        worker = threading.Thread(target=_worker)
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    for worker in workers:
+        worker.join()
+
+    return results
+
+
+def generate_srpms(config, projects, jobs=1, state=None, force=False,
+                   readers=None):
+    ''' Generate the new source rpm of each of the specified projects, using
+    up to ``jobs`` worker threads and the readers of the ``readers`` pool if
+    one is given.
+    Returns a dict associating each project to its new srpm, a project
+    failing does not prevent the others from being processed.
+    '''
+    def _process(project):
+        ''' Generate the srpm of a single project. '''
+        if get_build_method(config, project) == 'scm':
+            LOG.info('%s is built by copr from scm, skipping', project)
+            return
+        LOG.info('Processing project: %s', project)
+        return METRICS.profile(
+            project, generate_new_srpm, config, project, state=state,
+            force=force, readers=readers)
+
+    results = run_in_threads(_process, projects, jobs=jobs)
+    return dict(
+        (project, srpm) for project, srpm in results.items() if srpm)
 
-def get_chroots(copr_url, project_id, insecure=False):
-    ''' Given a project id, obtain list of names of enabled chroots. '''
-    try:
-        response = requests.get('%s/api_2/projects/%s/chroots' % (copr_url,
-                                                                  project_id),
-                                verify=not insecure)
-        return [obj['chroot']['name'] for obj in response.json()['chroots']]
-    except (ValueError, KeyError, IndexError):
-        raise DgrocException(
-            'Failed to find chroots for project %s.' % project_id)
 
+def uses_upload(config):
+    ''' Return whether the source rpms are uploaded somewhere copr
+    downloads them from, instead of being sent directly to copr. '''
+    return config.has_option('main', 'upload_command') \
+        or config.has_option('main', 'upload_target')
 
-def copr_build(config, srpms):
-    ''' Using the information provided in the configuration file,
-    run the build in copr.
+
+def upload_srpm(config, srpm, state=None):
+    ''' Upload the specified src.rpm using the `upload_command` of the
+    configuration file.
+    If a build state store is given, a src.rpm identical to one already
+    uploaded is not uploaded again.
+    Returns the url of the src.rpm uploaded, if `upload_url` is set.
     '''
+    srpm_url = None
+    if config.has_option('main', 'upload_url'):
+        srpm_url = config.get('main', 'upload_url') % os.path.basename(srpm)
+
+    digest, uploaded = find_upload(srpm, state)
+    if uploaded:
+        return uploaded
+
+    LOG.debug('Uploading source rpm: %s', srpm)
+    cmd = config.get('main', 'upload_command') % srpm
+    with METRICS.timer('upload'):
+        outcode = subprocess.call(cmd, shell=True)
+    if outcode:
+        METRICS.count('upload_failures')
+        raise DgrocException('Strange result with the command: `%s`' % cmd)
+    METRICS.count('upload_bytes', os.path.getsize(srpm))
+
+    if digest and srpm_url:
+        state.record_upload(digest, srpm_url=srpm_url)
+    return srpm_url
+
 
-    # dgroc config check
-    if config.has_option('main', 'upload_command') and \
-            not config.has_option('main', 'upload_url'):
+def find_upload(srpm, state=None):
+    ''' Return the SHA-256 of the src.rpm and the url at which an identical
+    src.rpm was already uploaded, if a build state store is given.
+    '''
+    if state is None:
+        return None, None
+    digest = file_sha256(srpm)
+    upload = state.find_upload(digest)
+    if upload and upload['srpm_url']:
+        LOG.info('Identical source rpm already uploaded at: %s',
+                 upload['srpm_url'])
+        METRICS.count('uploads_skipped')
+        return digest, upload['srpm_url']
+    return digest, None
+
+
+def upload_batch(config, uploader, srpms):
+    ''' Upload the specified src.rpms in a single transfer of the uploader.
+    All of them are sent, the uploader skipping the ones already uploaded,
+    so that they are all known to the uploader and never pruned.
+    Returns a dict associating each src.rpm to its url.
+    '''
+    if not config.has_option('main', 'upload_url'):
         raise DgrocException(
             'No `upload_url` specified in the `main` section of the dgroc '
             'configuration file.')
+    uploader.upload(srpms)
+    return dict(
+        (srpm, config.get('main', 'upload_url') % os.path.basename(srpm))
+        for srpm in srpms)
+
+
+class RsyncUploader(object):
+    ''' Upload the source rpms to the `upload_target` with rsync. A batch of
+    source rpms is sent in a single transfer: the files already on the
+    target are skipped by checksum and the others are sent as deltas of
+    similar files already there, such as the source rpm of the previous
+    commit. The transfers and the pruning of a remote target all go through
+    a single ssh connection, kept open until close().
+    '''
+
+    def __init__(self, target, max_age=None):
+        self.max_age = max_age
+        self.host = None
+        folder = target
+        if ':' in target.split('/')[0]:
+            if '::' in target or target.startswith('rsync://'):
+                raise DgrocException(
+                    'The upload_target %s is an rsync daemon module, only '
+                    'local and ssh targets are supported' % target)
+            self.host, folder = target.split(':', 1)
+        elif not target:
+            raise DgrocException('The upload_target is empty')
+        # A remote folder left empty is the home directory of the user
+        if folder and not folder.endswith('/'):
+            folder += '/'
+        self.target = '%s:%s' % (self.host, folder) if self.host else folder
+        self.folder = folder or '.'
+        self.uploaded = set()
+        self._control = None
+
+    def _ssh(self):
+        ''' Return the ssh command sharing the connection to the host. '''
+        if self._control is None:
+            self._control = tempfile.mkdtemp(prefix='dgroc-ssh-')
+        return [
+            'ssh', '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s' % os.path.join(self._control, '%r@%h:%p'),
+            '-o', 'ControlPersist=%s' % SSH_PERSIST]
+
+    def upload(self, srpms):
+        ''' Send the source rpms to the target in a single transfer. '''
+        cmd = ['rsync', '--checksum', '--fuzzy', '--partial',
+               '--itemize-changes']
+        if self.host:
+            cmd += ['-e', ' '.join(self._ssh())]
+        cmd += list(srpms) + [self.target]
+        LOG.debug('Uploading %s source rpms to %s', len(srpms), self.target)
+        with METRICS.timer('upload'):
+            proc = subprocess.Popen(
+                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            out = proc.communicate()
+        if proc.returncode:
+            METRICS.count('upload_failures', len(srpms))
+            raise DgrocException(
+                'Strange result with the command: `%s`:\n%s' % (
+                    ' '.join(cmd), out[1].strip()))
+
+        # Only the files actually sent are itemized
+        sent = set(
+            row.split(' ', 1)[1] for row in out[0].splitlines()
+            if row.startswith('<f'))
+        for srpm in srpms:
+            name = os.path.basename(srpm)
+            self.uploaded.add(name)
+            if name in sent:
+                METRICS.count('upload_bytes', os.path.getsize(srpm))
+            else:
+                LOG.info('Source rpm already on %s: %s', self.target, name)
+                METRICS.count('uploads_skipped')
+
+    def prune(self):
+        ''' Remove from the target the source rpms older than ``max_age``
+        days, except the ones uploaded by this uploader.
+        Returns the names of the source rpms removed.
+        '''
+        if not self.max_age:
+            return []
+        args = [self.folder, '-maxdepth', '1', '-type', 'f',
+                '-name', '*.src.rpm', '-mtime', '+%d' % self.max_age]
+        for name in sorted(self.uploaded):
+            args += ['!', '-name', name]
+        args += ['-print', '-delete']
+        if self.host:
+            cmd = self._ssh() + [self.host, ' '.join(
+                ['find'] + [pipes.quote(arg) for arg in args])]
+        else:
+            cmd = ['find'] + args
+        proc = subprocess.Popen(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out = proc.communicate()
+        if proc.returncode:
+            raise DgrocException(
+                'Could not prune %s: %s' % (self.target, out[1].strip()))
+        removed = [os.path.basename(row) for row in out[0].splitlines()]
+        LOG.info('%s old source rpms removed from %s', len(removed),
+                 self.target)
+        METRICS.count('srpms_pruned', len(removed))
+        return removed
+
+    def close(self):
+        ''' Close the ssh connection to the host, if any. '''
+        if self._control is None:
+            return
+        if self.host:
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call(
+                    self._ssh() + ['-O', 'exit', self.host],
+                    stdout=devnull, stderr=devnull)
+        shutil.rmtree(self._control, ignore_errors=True)
+        self._control = None
+
+
+def get_uploader(config):
+    ''' Return the uploader to the `upload_target` of the main section, or
+    None if the source rpms are uploaded with the `upload_command`.
+    '''
+    if not config.has_option('main', 'upload_target'):
+        return None
+    max_age = None
+    if config.has_option('main', 'upload_max_age'):
+        max_age = config.getint('main', 'upload_max_age')
+    return RsyncUploader(config.get('main', 'upload_target'), max_age=max_age)
+
+
+def finish_uploads(config, uploader, state=None):
+    ''' Prune the upload target of the uploader and close it. If a build
+    state store is given, the source rpms removed are forgotten in it.
+    '''
+    try:
+        removed = uploader.prune()
+    except DgrocException, err:
+        LOG.info(err)
+        removed = []
+    finally:
+        uploader.close()
+    if state is not None and removed:
+        state.forget_uploads([
+            config.get('main', 'upload_url') % name for name in removed])
+
+
+def file_sha256(filename):
+    ''' Return the SHA-256 of the specified file, read in chunks. '''
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as stream:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MultipartUpload(object):
+    ''' multipart/form-data request body sending a file from disk in chunks,
+    so that it is never loaded in memory.
+    '''
+
+    def __init__(self, fields, name, filename, content_type):
+        self.boundary = uuid.uuid4().hex
+        head = []
+        for key, value in fields:
+            head.append(
+                '--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n'
+                '%s\r\n' % (self.boundary, key, value))
+        head.append(
+            '--%s\r\nContent-Disposition: form-data; name="%s"; '
+            'filename="%s"\r\nContent-Type: %s\r\n\r\n' % (
+                self.boundary, name, os.path.basename(filename),
+                content_type))
+        self._head = ''.join(head).encode('utf-8')
+        self._tail = ('\r\n--%s--\r\n' % self.boundary).encode('utf-8')
+        self._length = (
+            len(self._head) + os.path.getsize(filename) + len(self._tail))
+        self._stream = open(filename, 'rb')
+        self._parts = [self._head, self._stream, self._tail]
+
+    def rewind(self):
+        ''' Start sending the body again from its beginning. '''
+        self._stream.seek(0)
+        self._parts = [self._head, self._stream, self._tail]
+
+    @property
+    def content_type(self):
+        ''' The Content-Type header of the request. '''
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=CHUNK_SIZE):
+        ''' Return the next chunk of the body, empty once all was read. '''
+        if size is None or size < 0:
+            size = CHUNK_SIZE
+        while self._parts:
+            part = self._parts[0]
+            if part is self._stream:
+                chunk = part.read(size)
+                if chunk:
+                    return chunk
+            elif part:
+                self._parts[0] = part[size:]
+                return part[:size]
+            self._parts.pop(0)
+        return b''
+
+    def close(self):
+        ''' Close the file sent. '''
+        self._stream.close()
+
+
+class TokenBucket(object):
+    ''' Rate limit: up to ``burst`` calls may go through at once, then
+    ``rate`` calls per second.
+    '''
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, int(rate))
+        self._tokens = float(self.burst)
+        self._updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        ''' Wait until a call may go through. '''
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(
+                    self.burst,
+                    self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+def is_transient(method, response=None, error=None):
+    ''' Return whether a request that failed with this response or error
+    may succeed if sent again. A POST is only sent again if copr cannot
+    have processed it.
+    '''
+    idempotent = method.upper() != 'POST'
+    if error is not None:
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        return idempotent and isinstance(
+            error, (requests.ConnectionError, requests.Timeout))
+    if response.status_code in (429, 503):
+        return True
+    return idempotent and response.status_code in (500, 502, 504)
+
+
+def get_retry_after(response):
+    ''' Return the number of seconds the response asks to wait before
+    retrying, or None.
+    '''
+    if response is None or not response.headers.get('Retry-After'):
+        return None
+    value = response.headers['Retry-After'].strip()
+    if value.isdigit():
+        return int(value)
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(mktime_tz(parsed) - time.time(), 0)
+
+
+class CoprClient(object):
+    ''' Client of the copr API sharing a single keep-alive session between
+    all the calls and caching, in memory and optionally on disk, the
+    project ids and chroots of the coprs.
+
+    The requests are sent at most ``rate`` per second and ``concurrency`` at
+    a time, and the ones failing with a transient error are retried after
+    a jittered exponential delay, or the one asked by copr unless it is
+    longer than the maximum delay.
+    '''
+
+    def __init__(self, copr_url, username, login, token, insecure=False,
+                 pool_size=COPR_POOL_SIZE, cache_ttl=COPR_CACHE_TTL,
+                 cache_file=None, rate=COPR_RATE, burst=None,
+                 concurrency=None, retries=COPR_RETRIES,
+                 timeout=COPR_TIMEOUT):
+        self.copr_url = copr_url.rstrip('/')
+        self.username = username
+        self.cache_ttl = cache_ttl
+        self.cache_file = cache_file
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.retries = retries
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(concurrency or pool_size)
+        self.session = requests.Session()
+        self.session.auth = (login, token)
+        self.session.verify = not insecure
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._cache = {}
+        if cache_file and os.path.exists(cache_file):
+            try:
+                with open(cache_file) as stream:
+                    self._cache = json.load(stream)
+            except ValueError:
+                LOG.info('Ignoring invalid copr cache: %s', cache_file)
+
+    def _cached(self, key, lookup):
+        ''' Return the cached value for the key, calling ``lookup`` to
+        retrieve it if it is not cached or has expired.
+        '''
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(key)
+        if entry and entry[0] > now:
+            return entry[1]
+
+        value = lookup()
+        with self._lock:
+            self._cache[key] = [now + self.cache_ttl, value]
+            if self.cache_file:
+                self._save_cache()
+        return value
+
+    def _save_cache(self):
+        ''' Atomically write the cache to disk, the lock must be held. '''
+        _makedirs(os.path.dirname(os.path.abspath(self.cache_file)))
+        partial = '%s.part' % self.cache_file
+        with open(partial, 'w') as stream:
+            json.dump(self._cache, stream)
+        os.rename(partial, self.cache_file)
+
+    def url(self, path):
+        ''' Return the full url of the specified API path. '''
+        return '%s/%s' % (self.copr_url, path.lstrip('/'))
+
+    def request(self, method, path, **kwargs):
+        ''' Send the request to the specified API path, retrying it while it
+        fails with a transient error.
+        Returns the last response, raises a DgrocException if copr could
+        not be reached.
+        '''
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            if attempt and hasattr(kwargs.get('data'), 'rewind'):
+                kwargs['data'].rewind()
+            if self.bucket is not None:
+                self.bucket.acquire()
+            METRICS.count('http_requests')
+            response = error = None
+            try:
+                with self._slots:
+                    with METRICS.timer('http'):
+                        response = self.session.request(
+                            method, self.url(path), **kwargs)
+            except requests.RequestException, err:
+                error = err
+            if error is None and response.status_code < 400:
+                return response
+
+            METRICS.count('http_errors')
+            if attempt >= self.retries \
+                    or not is_transient(method, response, error):
+                if error is not None:
+                    raise DgrocException('Could not reach copr: %s' % error)
+                return response
+
+            delay = random.uniform(0, min(
+                COPR_MAX_RETRY_DELAY, COPR_RETRY_DELAY * 2 ** attempt))
+            retry_after = get_retry_after(response)
+            if retry_after is not None:
+                METRICS.count('http_throttled')
+                if retry_after > COPR_MAX_RETRY_DELAY:
+                    LOG.info('%s %s failed (%s), copr asks to retry in %ss, '
+                             'giving up', method, path, response.status_code,
+                             retry_after)
+                    return response
+                delay = min(COPR_MAX_RETRY_DELAY, retry_after + delay / 2)
+            attempt += 1
+            METRICS.count('http_retries')
+            LOG.info('%s %s failed (%s), retry %s/%s in %.1fs', method, path,
+                     error or response.status_code, attempt, self.retries,
+                     delay)
+            time.sleep(delay)
+
+    def get(self, path, **kwargs):
+        ''' GET the specified API path. '''
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        ''' POST to the specified API path. '''
+        return self.request('POST', path, **kwargs)
+
+    def patch(self, path, **kwargs):
+        ''' PATCH the specified API path. '''
+        return self.request('PATCH', path, **kwargs)
+
+    def get_project_id(self, owner, copr):
+        ''' Given owner and COPR name, find its internal id. '''
+        def _lookup():
+            try:
+                response = self.get(
+                    'api_2/projects', params=dict(owner=owner, name=copr))
+                project = response.json()['projects'][0]
+                return project['project']['id']
+            except (ValueError, KeyError, IndexError):
+                raise DgrocException(
+                    'Failed to find project id of %s/%s' % (owner, copr))
+        return self._cached('project_id/%s/%s' % (owner, copr), _lookup)
+
+    def get_chroots(self, owner, copr):
+        ''' Given owner and COPR name, obtain list of names of enabled
+        chroots. '''
+        def _lookup():
+            project_id = self.get_project_id(owner, copr)
+            try:
+                response = self.get('api_2/projects/%s/chroots' % project_id)
+                return [
+                    obj['chroot']['name'] for obj in response.json()['chroots']]
+            except (ValueError, KeyError, IndexError):
+                raise DgrocException(
+                    'Failed to find chroots for project %s.' % project_id)
+        return self._cached('chroots/%s/%s' % (owner, copr), _lookup)
+
+    def build_status(self, build_id):
+        ''' Return the status of the specified build. '''
+        req = self.get('api/coprs/build_status/%s/' % build_id)
+
+        if '<title>Sign in Coprs</title>' in req.text:
+            raise DgrocException('Invalid API token')
+
+        if req.status_code == 404:
+            raise DgrocException('Build %s not found.' % build_id)
 
+        try:
+            output = req.json()
+        except ValueError:
+            LOG.debug(req.url)
+            LOG.debug(req.text)
+            raise DgrocException('Unknown response from server.')
+        if req.status_code != 200:
+            raise DgrocException(
+                'Something went wrong:\n  %s' % output.get('error'))
+        return output['status']
+
+    def cancel_build(self, build_id):
+        ''' Cancel the specified build. '''
+        req = self.patch(
+            'api_2/builds/%s' % build_id, json={'state': 'canceled'})
+        if req.status_code not in (
+                requests.codes.ok, requests.codes.no_content):
+            try:
+                message = req.json()['message']
+            except (ValueError, KeyError, TypeError):
+                message = req.text
+            raise DgrocException(
+                'Could not cancel build %s: %s' % (build_id, message))
+
+    def list_builds(self, owner, copr, limit):
+        ''' Return a dict associating the identifier of the last ``limit``
+        builds of the specified copr to their status, in a single call.
+        '''
+        project_id = self.get_project_id(owner, copr)
+        try:
+            req = self.get(
+                'api_2/builds', params=dict(project_id=project_id, limit=limit))
+            return dict(
+                (str(obj['build']['id']), obj['build']['state'])
+                for obj in req.json()['builds'])
+        except (ValueError, KeyError, TypeError):
+            raise DgrocException(
+                'Failed to list the builds of %s/%s' % (owner, copr))
+
+    def close(self):
+        ''' Close the connections of the session. '''
+        self.session.close()
+
+
+def get_copr_client(config):
+    ''' Return a copr client set up from the configuration file. '''
     if not config.has_option('main', 'copr_url'):
         warnings.warn(
             'No `copr_url` option set in the `main` section of the dgroc '
@@ -437,8 +2811,6 @@ def copr_build(config, srpms):
     else:
         copr_url = config.get('main', 'copr_url')
 
-    copr_url = copr_url.rstrip('/')
-
     insecure = False
     if config.has_option('main', 'no_ssl_check') \
             and config.get('main', 'no_ssl_check'):
@@ -447,118 +2819,968 @@ def copr_build(config, srpms):
             "certificate when submitting the builds to copr")
         insecure = config.get('main', 'no_ssl_check')
 
+    kwargs = {}
+    if config.has_option('main', 'copr_pool_size'):
+        kwargs['pool_size'] = config.getint('main', 'copr_pool_size')
+    if config.has_option('main', 'copr_cache_ttl'):
+        kwargs['cache_ttl'] = config.getint('main', 'copr_cache_ttl')
+    if config.has_option('main', 'copr_cache_file'):
+        kwargs['cache_file'] = os.path.expanduser(
+            config.get('main', 'copr_cache_file'))
+    if config.has_option('main', 'copr_rate'):
+        kwargs['rate'] = config.getfloat('main', 'copr_rate')
+    if config.has_option('main', 'copr_burst'):
+        kwargs['burst'] = config.getint('main', 'copr_burst')
+    if config.has_option('main', 'copr_concurrency'):
+        kwargs['concurrency'] = config.getint('main', 'copr_concurrency')
+    if config.has_option('main', 'copr_retries'):
+        kwargs['retries'] = config.getint('main', 'copr_retries')
+    if config.has_option('main', 'copr_timeout'):
+        kwargs['timeout'] = config.getfloat('main', 'copr_timeout')
+
     copr_config = config.get('main', 'copr_config')
     username, login, token = _get_copr_auth(copr_config)
 
-    build_ids = []
-    # Build project/srpm in copr
-    for project in srpms:
-        if config.has_option(project, 'copr'):
-            copr = config.get(project, 'copr')
-        else:
-            copr = project
+    return CoprClient(
+        copr_url, username, login, token, insecure=insecure, **kwargs)
 
-        project_id = get_project_id(copr_url, username, copr, insecure=insecure)
 
-        metadata = {
-            'project_id': project_id,
-            'chroots': get_chroots(copr_url, project_id, insecure=insecure),
-        }
-        url = '%s/api_2/builds' % (copr_url)
-        srpm_name = os.path.basename(srpms[project])
+def log_copr_error(req):
+    ''' Log why copr refused to start a build. '''
+    LOG.error('Failed to start build in COPR')
+    LOG.error('Status code was %d: %s', req.status_code, req.reason)
+    try:
+        LOG.error(req.json()['message'])
+    except (ValueError, KeyError, TypeError):
+        LOG.error(req.text)
+
+
+def submit_build(config, client, project, srpm, srpm_url=None, state=None,
+                 force=False):
+    ''' Start the build of the source rpm of the project in copr.
+    If a build state store is given, a source rpm identical to one already
+    uploaded directly to the same copr is not built again while that build
+    is in progress or succeeded, unless ``force`` is True.
+    Returns the identifier of the build started.
+    '''
+    if uses_upload(config) and not config.has_option('main', 'upload_url'):
+        raise DgrocException(
+            'No `upload_url` specified in the `main` section of the dgroc '
+            'configuration file.')
 
-        if config.has_option('main', 'upload_command'):
-            # SRPMs are uploaded to remote location.
-            srpm_file = config.get('main', 'upload_url') % srpm_name
+    copr = get_copr_name(config, project)
+    metadata = {
+        'project_id': client.get_project_id(client.username, copr),
+        'chroots': client.get_chroots(client.username, copr),
+    }
+    srpm_name = os.path.basename(srpm)
+
+    digest = None
+    if uses_upload(config):
+        # SRPMs are uploaded to remote location.
+        srpm_file = srpm_url or config.get('main', 'upload_url') % srpm_name
+
+        metadata['srpm_url'] = srpm_file
+        with METRICS.timer('submit', project):
+            req = client.post('api_2/builds', json=metadata)
+    else:
+        # Directly upload SRPM to COPR
+        if state is not None:
+            digest = file_sha256(srpm)
+            upload = state.find_upload(digest, copr)
+            if upload and upload['build_id'] and not force:
+                try:
+                    status = client.build_status(upload['build_id'])
+                except DgrocException, err:
+                    LOG.info('Could not check build %s: %s',
+                             upload['build_id'], err)
+                    status = None
+                if status in IN_PROGRESS or status == 'succeeded':
+                    LOG.info('Identical source rpm already built in %s: %s '
+                             '(%s)', copr, upload['build_id'], status)
+                    METRICS.count('uploads_skipped', project=project)
+                    return upload['build_id']
+
+        body = MultipartUpload(
+            [('metadata', json.dumps(metadata))], 'srpm', srpm,
+            'application/x-rpm')
+        try:
+            with METRICS.timer('submit', project):
+                req = client.post(
+                    'api_2/builds', data=body,
+                    headers={'Content-Type': body.content_type})
+        finally:
+            body.close()
+        METRICS.count('upload_bytes', len(body), project=project)
+
+    if req.status_code != requests.codes.created:
+        METRICS.count('submit_failures', project=project)
+        log_copr_error(req)
+        raise DgrocException('Failed to start build in COPR')
+
+    build_url = req.headers.get('Location')
+    if not build_url:
+        METRICS.count('submit_failures', project=project)
+        raise DgrocException('Copr did not say which build was started')
+    build_id = build_url.split('/')[-1]
+    LOG.info('Build %s started in copr', build_id)
+    METRICS.count('builds_submitted', project=project)
+    if digest:
+        state.record_upload(digest, copr, build_id=build_id)
+    if state is not None:
+        cancel_superseded(
+            config, client, state, project, build_id, metadata['chroots'])
+    return build_id
+
+
+def submit_scm_build(config, client, project, source, state=None):
+    ''' Start the build of the project in copr straight from its
+    repository, ``source`` being returned by prepare_scm_build().
+    Returns the identifier of the build started.
+    '''
+    copr = get_copr_name(config, project)
+    chroots = client.get_chroots(client.username, copr)
+    metadata = {
+        'ownername': client.username,
+        'projectname': copr,
+        'chroots': chroots,
+        'scm_type': 'git',
+        'clone_url': source['clone_url'],
+        'committish': source['committish'],
+        'subdirectory': source['subdirectory'],
+        'spec': source['spec'],
+        'source_build_method': 'rpkg',
+    }
+    with METRICS.timer('submit', project):
+        req = client.post('api_3/build/create/scm', json=metadata)
+    if req.status_code != requests.codes.ok:
+        METRICS.count('submit_failures', project=project)
+        log_copr_error(req)
+        raise DgrocException('Failed to start build in COPR')
+    try:
+        build_id = str(req.json()['id'])
+    except (ValueError, KeyError, TypeError):
+        METRICS.count('submit_failures', project=project)
+        raise DgrocException('Copr did not say which build was started')
+
+    LOG.info('Build %s of %s started in copr from %s', build_id,
+             source['release'], source['clone_url'])
+    METRICS.count('builds_submitted', project=project)
+    if state is not None:
+        cancel_superseded(config, client, state, project, build_id, chroots)
+    return build_id
+
+
+def get_cancel_policy(config):
+    ''' Return the statuses of the superseded builds to cancel, according
+    to the `cancel_superseded` option of the main section.
+    '''
+    policy = 'pending'
+    if config.has_option('main', 'cancel_superseded'):
+        policy = config.get('main', 'cancel_superseded')
+    if policy not in CANCEL_POLICIES:
+        raise DgrocException(
+            'Unknown "cancel_superseded" policy: %s, valid policies are: %s'
+            % (policy, ', '.join(sorted(CANCEL_POLICIES))))
+    return CANCEL_POLICIES[policy]
+
+
+def cancel_superseded(config, client, state, project, build_id, chroots):
+    ''' Cancel the builds of the project still in flight in the chroots of
+    its new build, since they build an older commit, and record the new
+    build as in flight instead.
+    Depending on the `cancel_superseded` option, only the builds not started
+    yet (``pending``), all of them (``all``) or none (``none``) are
+    cancelled; a build is only cancelled if all its chroots are superseded.
+    '''
+    cancelable = get_cancel_policy(config)
 
-            metadata['srpm_url'] = srpm_file
-            req = requests.post(
-                url, auth=(login, token), json=metadata, verify=not insecure)
+    for old_id, old_chroots in state.inflight(project).items():
+        if old_id == str(build_id) or not set(old_chroots) <= set(chroots):
+            continue
+        try:
+            status = client.build_status(old_id)
+        except DgrocException, err:
+            LOG.info('Could not check superseded build %s: %s', old_id, err)
+            continue
+        if status not in IN_PROGRESS:
+            state.set_result(old_id, status)
+        elif status in cancelable:
+            try:
+                client.cancel_build(old_id)
+            except DgrocException, err:
+                LOG.info(err)
+                continue
+            LOG.info('Build %s (%s) superseded by %s: canceled', old_id,
+                     status, build_id)
+            METRICS.count('builds_canceled', project=project)
+            state.clear_inflight(old_id)
         else:
-            # Directly upload SRPM to COPR
-            files = {
-                'srpm': (srpm_name, open(srpms[project], 'rb'),
-                         'application/x-rpm'),
-                'metadata': ('', json.dumps(metadata)),
-            }
-            req = requests.post(
-                url, auth=(login, token), files=files, verify=not insecure)
+            LOG.debug('Build %s superseded by %s is %s, leaving it',
+                      old_id, build_id, status)
+
+    state.record_inflight(project, build_id, chroots)
 
-        if req.status_code != requests.codes.created:
-            LOG.error('Failed to start build in COPR')
-            LOG.error('Status code was %d: %s', req.status_code, req.reason)
+
+class Stage(object):
+    ''' A stage of the pipeline: a pool of worker threads calling a function
+    on each project read from the inbox queue and passing what it returns,
+    unless None, to the outbox queue of the next stage.
+    '''
+
+    def __init__(self, name, function, jobs, inbox, outbox=None):
+        self.name = name
+        self.function = function
+        self.jobs = max(jobs, 1)
+        self.inbox = inbox
+        self.outbox = outbox
+        self._workers = []
+
+    def start(self):
+        ''' Start the workers of the stage. '''
+        for _ in range(self.jobs):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        return self
+
+    def _work(self):
+        ''' Process the items of the inbox until told to stop. '''
+        thread = threading.current_thread()
+        while True:
+            item = self.inbox.get()
+            if item is None:
+                return
+            project, data = item
+            thread.name = project
             try:
-                LOG.error(req.json()['message'])
-            except ValueError:
-                LOG.error(req.text)
+                result = self.function(project, data)
+            except DgrocException, err:
+                LOG.info('%s: %s', project, err)
+                continue
+            except Exception:
+                LOG.exception('%s: unexpected error during %s', project,
+                              self.name)
+                continue
+            if result is not None and self.outbox is not None:
+                self.outbox.put((project, result))
+
+    def join(self):
+        ''' Wait for the workers to have processed all the items already in
+        the inbox.
+        '''
+        for _ in self._workers:
+            self.inbox.put(None)
+        for worker in self._workers:
+            worker.join()
+
+
+class BatchStage(Stage):
+    ''' A stage of the pipeline whose function is called on batches of
+    items: all the items waiting in the inbox when a worker gets to them,
+    up to ``batch_size``. The function returns a dict associating each
+    project of the batch to its result, the projects left out failed.
+    '''
+
+    def __init__(self, name, function, jobs, inbox, outbox=None,
+                 batch_size=UPLOAD_BATCH_SIZE):
+        Stage.__init__(self, name, function, jobs, inbox, outbox=outbox)
+        self.batch_size = batch_size
+
+    def _work(self):
+        ''' Process the items of the inbox by batches until told to stop. '''
+        threading.current_thread().name = self.name
+        stop = False
+        while not stop:
+            batch = []
+            item = self.inbox.get()
+            while item is not None:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.inbox.get_nowait()
+                except Queue.Empty:
+                    break
+            # Each worker stops on its own end marker, even mid-batch
+            stop = item is None
+            if not batch:
+                continue
+
+            projects = [project for project, _ in batch]
+            try:
+                results = self.function(batch)
+            except DgrocException, err:
+                LOG.info('%s: %s', ', '.join(projects), err)
+                continue
+            except Exception:
+                LOG.exception('%s: unexpected error during %s',
+                              ', '.join(projects), self.name)
+                continue
+            for project in projects:
+                result = results.get(project)
+                if result is not None and self.outbox is not None:
+                    self.outbox.put((project, result))
+
+
+def run_pipeline(config, projects, state, client, jobs=1, upload_jobs=1,
+                 submit_jobs=1, force=False, readers=None, deadline=None):
+    ''' Generate the source rpm of the projects, upload them and start
+    their build in copr as a streaming pipeline: each source rpm is
+    uploaded and submitted as soon as it is generated. Each stage has its
+    own number of workers and the queues between them are bounded.
+    The projects are generated in the order given and, if a ``deadline``
+    is given, the ones whose generation is not expected to be over by then
+    are postponed to the next run.
+    The readers of the projects are taken from the ``readers`` pool if one
+    is given.
+    Returns a dict associating each project to its new srpm and a dict
+    associating the identifier of each build started to its project.
+    '''
+    srpms = {}
+    builds = {}
+    lock = threading.Lock()
+    scm = lambda project: get_scm(config, project)
+    durations = state.durations() if deadline is not None else {}
+
+    def _generate(project, _):
+        ''' Generate the srpm of the project, or find the commit copr has
+        to build if it is built from scm. '''
+        if deadline is not None:
+            expected = durations.get(project, {}).get('generate') or 0
+            if time.time() + expected > deadline:
+                LOG.info('Postponing %s: not enough time left in the run',
+                         project)
+                METRICS.count('projects_postponed')
+                return
+        LOG.info('Processing project: %s', project)
+        start = time.time()
+        if get_build_method(config, project) == 'scm':
+            source = prepare_scm_build(
+                config, project, state=state, force=force)
+            if not source:
+                return
+            state.record_duration(project, 'generate', time.time() - start)
+            return (None, source)
+        srpm = METRICS.profile(
+            project, generate_new_srpm, config, project, state=state,
+            force=force, readers=readers)
+        if not srpm:
+            return
+        state.record_duration(project, 'generate', time.time() - start)
+        with lock:
+            srpms[project] = srpm
+        return (srpm, None)
+
+    def _upload(project, data):
+        ''' Upload the srpm of the project. '''
+        srpm = data[0]
+        if srpm is None:
+            # Built from scm, there is nothing to upload
+            return data
+        try:
+            srpm_url = upload_srpm(config, srpm, state=state)
+        except DgrocException:
+            state.update(project, scm(project), result='upload-failed')
+            raise
+        return (srpm, srpm_url)
+
+    def _upload_batch(batch):
+        ''' Upload the srpms of the batch in a single transfer. '''
+        results = dict(
+            (project, data) for project, data in batch if data[0] is None)
+        srpms = dict(
+            (project, data[0]) for project, data in batch
+            if data[0] is not None)
+        if not srpms:
+            return results
+        try:
+            urls = upload_batch(config, uploader, srpms.values())
+        except DgrocException, err:
+            # The projects built from scm still go on
+            LOG.info('%s: %s', ', '.join(sorted(srpms)), err)
+            for project in srpms:
+                state.update(project, scm(project), result='upload-failed')
+            return results
+        for project, srpm in srpms.items():
+            results[project] = (srpm, urls[srpm])
+        return results
+
+    def _submit(project, data):
+        ''' Start the build of the srpm of the project. '''
+        srpm, srpm_url = data
+        try:
+            if srpm is None:
+                # Built from scm, copr is sent the source of the build
+                build_id = submit_scm_build(
+                    config, client, project, data[1], state=state)
+            else:
+                build_id = submit_build(
+                    config, client, project, srpm, srpm_url=srpm_url,
+                    state=state, force=force)
+        except DgrocException:
+            state.update(project, scm(project), result='submit-failed')
+            raise
+        state.update(
+            project, scm(project), build_id=build_id, result='submitted')
+        with lock:
+            builds[build_id] = project
+
+    to_generate = Queue.Queue()
+    for project in projects:
+        to_generate.put((project, None))
+    to_submit = Queue.Queue(maxsize=QUEUE_SIZE * submit_jobs)
+
+    stages = []
+    uploader = get_uploader(config)
+    if uploader is not None:
+        to_upload = Queue.Queue(maxsize=UPLOAD_BATCH_SIZE * upload_jobs)
+        stages.append(Stage('generation', _generate, jobs, to_generate,
+                            to_upload))
+        stages.append(BatchStage('upload', _upload_batch, upload_jobs,
+                                 to_upload, to_submit))
+    elif config.has_option('main', 'upload_command'):
+        to_upload = Queue.Queue(maxsize=QUEUE_SIZE * upload_jobs)
+        stages.append(Stage('generation', _generate, jobs, to_generate,
+                            to_upload))
+        stages.append(Stage('upload', _upload, upload_jobs, to_upload,
+                            to_submit))
+    else:
+        LOG.info(
+            'No `upload_command` specified in the `main` section of the '
+            'configuration file. Attempting to build by direct upload.')
+        stages.append(Stage('generation', _generate, jobs, to_generate,
+                            to_submit))
+    stages.append(Stage('submission', _submit, submit_jobs, to_submit))
+
+    for stage in stages:
+        stage.start()
+    # Stop the stages in order, once the previous one has fed them all
+    for stage in stages:
+        stage.join()
+    if uploader is not None:
+        finish_uploads(config, uploader, state=state)
 
-        build_url = req.headers['Location']
-        build_id = build_url.split('/')[-1]
-        build_ids.append(build_id)
+    return srpms, builds
 
-    return build_ids
 
+class BuildMonitor(object):
+    ''' Follow builds running in copr until they are all finished.
 
-def check_copr_build(config, build_ids):
-    ''' Check the status of builds running in copr.
+    Each build is checked on its own schedule: the delay between two checks
+    doubles, up to a maximum, as long as its status does not change. The
+    builds due are checked concurrently, using when possible a single call
+    listing the last builds of their copr, and leave the monitored set as
+    soon as they are finished.
     '''
 
-    ## dgroc config check
-    if not config.has_option('main', 'copr_url'):
-        warnings.warn(
-            'No `copr_url` option set in the `main` section of the dgroc '
-            'configuration file, using default: %s' % COPR_URL)
-        copr_url = COPR_URL
-    else:
-        copr_url = config.get('main', 'copr_url')
+    def __init__(self, config, client, builds, state=None):
+        self.config = config
+        self.client = client
+        self.state = state
+        self.interval = MONITOR_INTERVAL
+        self.max_interval = MONITOR_MAX_INTERVAL
+        self.jobs = MONITOR_JOBS
+        self.batch = True
+        if config.has_option('main', 'monitor_interval'):
+            self.interval = config.getint('main', 'monitor_interval')
+        if config.has_option('main', 'monitor_max_interval'):
+            self.max_interval = config.getint('main', 'monitor_max_interval')
+        if config.has_option('main', 'monitor_jobs'):
+            self.jobs = config.getint('main', 'monitor_jobs')
+        if config.has_option('main', 'monitor_batch'):
+            self.batch = config.getboolean('main', 'monitor_batch')
+
+        # build id -> project
+        self.projects = {}
+        # build id -> [next check, delay, last status, errors]
+        self._pending = {}
+        # build id -> final status
+        self.results = {}
+        for build_id, project in builds.items():
+            self.add(build_id, project)
+
+    def add(self, build_id, project):
+        ''' Start monitoring the specified build of the project. '''
+        build_id = str(build_id)
+        self.projects[build_id] = project
+        self._pending[build_id] = [
+            time.time() + self.interval, self.interval, None, 0]
+
+    def _batch_statuses(self, build_ids):
+        ''' Retrieve the status of the builds with one call per copr.
+        Returns a dict associating the builds found to their status.
+        '''
+        coprs = {}
+        for build_id in build_ids:
+            copr = get_copr_name(self.config, self.projects[build_id])
+            coprs.setdefault(copr, []).append(build_id)
+
+        def _list(copr):
+            ''' List the last builds of the copr. '''
+            limit = max(len(coprs[copr]) * 2, 20)
+            return self.client.list_builds(
+                self.client.username, copr, limit)
+
+        listings = run_in_threads(_list, coprs, jobs=self.jobs)
+        if coprs and not listings:
+            LOG.info('Could not list the builds, checking them one by one')
+            self.batch = False
+
+        statuses = {}
+        for copr, listing in listings.items():
+            for build_id in coprs[copr]:
+                if build_id in listing:
+                    statuses[build_id] = listing[build_id]
+        return statuses
+
+    def poll(self, build_ids):
+        ''' Check the status of the specified builds.
+        Returns a dict associating the builds checked to their status.
+        '''
+        with METRICS.timer('poll'):
+            statuses = {}
+            if self.batch:
+                statuses = self._batch_statuses(build_ids)
+            remaining = [
+                build_id for build_id in build_ids if build_id not in statuses]
+            statuses.update(run_in_threads(
+                self.client.build_status, remaining, jobs=self.jobs))
+        return statuses
+
+    def _update(self, build_id, status):
+        ''' Record the status of the build and schedule its next check. '''
+        entry = self._pending[build_id]
+        if status is None:
+            entry[3] += 1
+            if entry[3] >= MONITOR_MAX_ERRORS:
+                LOG.info('  Build %s: giving up after %s failed checks',
+                         build_id, entry[3])
+                self._finish(build_id, 'unknown')
+                return
+            entry[1] = min(entry[1] * 2, self.max_interval)
+        elif status not in IN_PROGRESS:
+            LOG.info('  Build %s (%s): %s',
+                     build_id, self.projects[build_id], status)
+            self._finish(build_id, status)
+            return
+        elif status != entry[2]:
+            LOG.info('  Build %s (%s): %s',
+                     build_id, self.projects[build_id], status)
+            entry[1] = self.interval
+            entry[2] = status
+            entry[3] = 0
+        else:
+            entry[1] = min(entry[1] * 2, self.max_interval)
+            entry[3] = 0
+        entry[0] = time.time() + entry[1]
+
+    def _finish(self, build_id, status):
+        ''' Stop monitoring the build and record its final status, as well
+        as how long copr took to build it. '''
+        del self._pending[build_id]
+        self.results[build_id] = status
+        METRICS.count('builds_%s' % status, project=self.projects[build_id])
+        if self.state is None:
+            return
+        if status in ('succeeded', 'failed'):
+            started = self.state.submitted_at(build_id)
+            if started is not None:
+                self.state.record_duration(
+                    self.projects[build_id], 'build', time.time() - started)
+        self.state.set_result(build_id, status)
+
+    def run(self):
+        ''' Check the builds until they are all finished.
+        Returns a dict associating each build to its final status.
+        '''
+        LOG.info('Monitoring %s builds...', len(self._pending))
+        with METRICS.timer('monitor'):
+            self._wait()
+        self.summary()
+        return self.results
+
+    def _wait(self):
+        ''' Check the builds due until they are all finished. '''
+        while self._pending:
+            next_check = self.step()
+            if next_check is not None:
+                time.sleep(max(next_check - time.time(), 0))
+
+    def step(self):
+        ''' Check the builds that are due, if any.
+        Returns the time at which the next check is due, or None if there
+        are no builds left to monitor.
+        '''
+        now = time.time()
+        due = [
+            build_id for build_id, entry in self._pending.items()
+            if entry[0] <= now]
+        if due:
+            statuses = self.poll(due)
+            for build_id in due:
+                self._update(build_id, statuses.get(build_id))
+            LOG.debug('%s builds still in progress', len(self._pending))
+        if not self._pending:
+            return None
+        return min(entry[0] for entry in self._pending.values())
+
+    def drain(self):
+        ''' Forget the builds that are finished.
+        Returns a dict associating each of them to its final status.
+        '''
+        results = self.results
+        self.results = {}
+        for build_id in results:
+            del self.projects[build_id]
+        return results
+
+    def summary(self):
+        ''' Log the final status of every build monitored. '''
+        LOG.info('Builds summary:')
+        for build_id in sorted(self.results):
+            LOG.info('  %-30s %-10s %s', self.projects[build_id], build_id,
+                     self.results[build_id])
+
+
+def check_config(config):
+    ''' Check that the main section of the configuration file has the
+    options required to build the projects.
+    '''
+    if not config.has_option('main', 'username'):
+        raise DgrocException(
+            'No `username` specified in the `main` section of the '
+            'configuration file.')
 
-    if not copr_url.endswith('/'):
-        copr_url = '%s/' % copr_url
+    if not config.has_option('main', 'email'):
+        raise DgrocException(
+            'No `email` specified in the `main` section of the '
+            'configuration file.')
 
-    insecure = False
-    if config.has_option('main', 'no_ssl_check') \
-            and config.get('main', 'no_ssl_check'):
-        warnings.warn(
-            "Option `no_ssl_check` was set to True, we won't check the ssl "
-            "certificate when submitting the builds to copr")
-        insecure = config.get('main', 'no_ssl_check')
+    get_cancel_policy(config)
 
-    copr_config = config.get('main', 'copr_config')
-    username, login, token = _get_copr_auth(copr_config)
 
-    build_ip = []
-    ## Build project/srpm in copr
-    for build_id in build_ids:
+def get_projects(config):
+    ''' Return the projects of the configuration file. '''
+    return [project for project in config.sections() if project != 'main']
 
-        URL = '%s/api/coprs/build_status/%s/' % (
-            copr_url,
-            build_id)
 
-        req = requests.get(
-            URL, auth=(login, token), verify=not insecure)
+def changed_projects(config, projects, state):
+    ''' Return the projects whose remote moved, or whose spec file or
+    patches changed, since their last build, or whose last source rpm still
+    has to be sent to copr.
+    '''
+    projects = list(projects)
+    status = check_remotes(config, projects, state=state)
+    for project, info in status.items():
+        if not info['changed'] \
+                and info['result'] not in BuildState.UNSUBMITTED:
+            LOG.info('%s: commit %s already built', project, info['built'])
+            projects.remove(project)
+    return projects
+
+
+def get_priority(config, project):
+    ''' Return the priority of the project, the projects with the highest
+    priority being processed first. '''
+    if config.has_option(project, 'priority'):
+        return config.getint(project, 'priority')
+    return 0
+
+
+def order_projects(config, projects, state):
+    ''' Return the projects sorted by decreasing priority then, using the
+    durations recorded for them, longest first so that the longest builds
+    do not end the run. The projects never built come first, as they may
+    be long too.
+    '''
+    durations = state.durations()
 
-        if '<title>Sign in Coprs</title>' in req.text:
-            LOG.info("Invalid API token")
-            return
+    def _key(project):
+        ''' Sort the projects by priority then by expected duration. '''
+        expected = durations.get(project)
+        if expected is None:
+            expected = float('inf')
+        else:
+            expected = sum(value or 0 for value in expected.values())
+        return (-get_priority(config, project), -expected)
 
-        if req.status_code == 404:
-            LOG.info("Build %s not found.", build_id)
+    return sorted(projects, key=_key)
+
+
+def get_deadline(config, start):
+    ''' Return the time after which no new project is processed, given
+    the `max_runtime` of the main section, or None. '''
+    if not config.has_option('main', 'max_runtime'):
+        return None
+    try:
+        max_runtime = parse_duration(config.get('main', 'max_runtime'))
+    except DgrocException:
+        raise DgrocException(
+            'Invalid "max_runtime": %s' % config.get('main', 'max_runtime'))
+    return start + max_runtime if max_runtime else None
+
+
+def process_projects(config, args, projects, state, client=None,
+                     readers=None):
+    ''' Generate the source rpms of the projects and, unless only source
+    rpms are requested or no copr client is given, start their build in
+    copr. The projects are processed by priority, longest first, within
+    the `max_runtime` budget of the run.
+    Returns a dict associating the identifier of each build started to its
+    project.
+    '''
+    start = time.time()
+    reset_run_caches()
+    if not args.force:
+        # Only pull the projects whose remote moved since their last build
+        projects = changed_projects(config, projects, state)
+    projects = order_projects(config, projects, state)
+
+    if args.srpmonly or client is None:
+        srpms = generate_srpms(
+            config, projects, jobs=args.jobs, state=state, force=args.force,
+            readers=readers)
+        LOG.info('%s srpms generated', len(srpms))
+        return {}
+
+    srpms, builds = run_pipeline(
+        config, projects, state, client, jobs=args.jobs,
+        upload_jobs=args.upload_jobs, submit_jobs=args.submit_jobs,
+        force=args.force, readers=readers,
+        deadline=get_deadline(config, start))
+    LOG.info('%s srpms generated, %s builds started', len(srpms), len(builds))
+    return builds
+
+
+def build(config, args):
+    ''' Generate the source rpms of the projects that changed and build them
+    in copr, as requested by the command line arguments.
+    '''
+    state = get_build_state(config)
+    for project in args.reset:
+        LOG.info('Resetting the build state of: %s', project)
+        state.reset(project)
+
+    clean_workspaces(config)
 
+    client = None
+    if not args.srpmonly:
         try:
-            output = req.json()
-        except ValueError:
-            LOG.info("Unknown response from server.")
-            LOG.debug(req.url)
-            LOG.debug(req.text)
+            client = get_copr_client(config)
+        except DgrocException, err:
+            LOG.info(err)
             return
-        if req.status_code != 200:
-            LOG.info("Something went wrong:\n  %s", output['error'])
+
+    builds = process_projects(config, args, get_projects(config), state, client)
+
+    if args.monitoring and builds:
+        BuildMonitor(config, client, builds, state=state).run()
+
+
+def parse_duration(value, units='s'):
+    ''' Return the number of seconds of the duration, which may end with
+    ``s``, ``m``, ``h`` or ``d`` for seconds, minutes, hours or days,
+    ``units`` being used otherwise.
+    '''
+    factors = {'s': 1, 'm': 60, 'h': 3600, 'd': 24 * 3600}
+    number, factor = value.strip(), factors[units]
+    if number and number[-1] in factors:
+        number, factor = number[:-1], factors[number[-1]]
+    try:
+        return int(float(number) * factor)
+    except ValueError:
+        raise DgrocException('Invalid duration: %s' % value)
+
+
+def get_interval(config, project):
+    ''' Return the number of seconds between two checks of the project by
+    the daemon, set for the project or in the main section. The value may
+    end with ``m``, ``h`` or ``d`` for minutes, hours or days.
+    '''
+    interval = str(SERVE_INTERVAL)
+    for section in (project, 'main'):
+        if config.has_option(section, 'interval'):
+            interval = config.get(section, 'interval')
+            break
+    try:
+        return parse_duration(interval)
+    except DgrocException:
+        raise DgrocException(
+            'Project "%s" has an invalid "interval": %s' % (project, interval))
+
+
+def export_metrics(args):
+    ''' Write the metrics of the run to the files requested by the command
+    line arguments.
+    '''
+    if args.metrics:
+        METRICS.write_json(args.metrics)
+        LOG.info('Metrics written to: %s', args.metrics)
+    if args.prometheus:
+        METRICS.write_prometheus(args.prometheus)
+
+
+class Daemon(object):
+    ''' Keep dgroc running: each project is checked, and built if it
+    changed, on its own schedule while the builds started are monitored.
+
+    The build state, the copr session and the readers of the projects are
+    kept open between runs. The configuration file is read again on SIGHUP
+    and the daemon stops, once done with the projects it is processing, on
+    SIGTERM or SIGINT.
+    '''
+
+    def __init__(self, args):
+        self.args = args
+        self.config = None
+        self.state = None
+        self.client = None
+        self.monitor = None
+        self.readers = ReaderPool()
+        # project -> time of its next check
+        self.schedule = {}
+        self._reload = False
+        self._stop = False
+
+    def load(self):
+        ''' Read the configuration file and set the daemon up from it,
+        the current setup is kept if the file is invalid.
+        '''
+        config = ConfigParser.ConfigParser(defaults={'copr_config': None})
+        try:
+            if not config.read(self.args.config):
+                raise DgrocException(
+                    'Could not read the configuration file: %s'
+                    % self.args.config)
+            check_config(config)
+            intervals = dict(
+                (project, get_interval(config, project))
+                for project in get_projects(config))
+            client = None
+            if not self.args.srpmonly:
+                client = get_copr_client(config)
+        except (ConfigParser.Error, DgrocException), err:
+            if self.config is None:
+                raise
+            LOG.error('Keeping the current configuration: %s', err)
             return
-        LOG.info('  Build %s: %s', build_id, output)
 
-        if output['status'] in ('pending', 'running'):
-            build_ip.append(build_id)
-    return build_ip
+        state = get_build_state(config)
+        if self.state is not None:
+            if self.state.path == state.path:
+                state.close()
+                state = self.state
+            else:
+                self.state.close()
+        if self.client is not None:
+            self.client.close()
+        self.config = config
+        self.state = state
+        self.client = client
+
+        if self.monitor is None:
+            for project in self.args.reset:
+                LOG.info('Resetting the build state of: %s', project)
+                state.reset(project)
+            builds = {}
+            if client is not None and self.args.monitoring:
+                # Resume monitoring the builds started before a restart
+                builds = state.unfinished()
+            self.monitor = BuildMonitor(config, client, builds, state=state)
+        self.monitor.config = config
+        self.monitor.client = client
+        self.monitor.state = state
+
+        now = time.time()
+        for project in list(self.schedule):
+            if project not in intervals:
+                LOG.info('%s: no longer scheduled', project)
+                del self.schedule[project]
+        for project, interval in intervals.items():
+            if project in self.schedule:
+                self.schedule[project] = min(
+                    self.schedule[project], now + interval)
+                continue
+            last = state.get(project, get_scm(config, project))
+            self.schedule[project] = now
+            if last and last['result'] not in BuildState.UNSUBMITTED:
+                self.schedule[project] = last['updated'] + interval
+        clean_workspaces(config)
+        LOG.info('Serving %s projects', len(self.schedule))
+
+    def process(self, projects):
+        ''' Check and build the specified projects and monitor their builds.
+        '''
+        METRICS.reset()
+        try:
+            builds = process_projects(
+                self.config, self.args, projects, self.state,
+                client=self.client, readers=self.readers)
+        finally:
+            export_metrics(self.args)
+        if self.args.monitoring:
+            for build_id, project in builds.items():
+                self.monitor.add(build_id, project)
+
+    def _on_reload(self, signum, frame):
+        ''' Ask for the configuration file to be read again. '''
+        self._reload = True
+
+    def _on_stop(self, signum, frame):
+        ''' Ask the daemon to stop. '''
+        self._stop = True
+
+    def run(self):
+        ''' Process the projects when they are due until asked to stop. '''
+        self.load()
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        try:
+            while not self._stop:
+                if self._reload:
+                    self._reload = False
+                    LOG.info('Reloading the configuration file')
+                    self.load()
+
+                now = time.time()
+                due = sorted(
+                    project for project, next_check in self.schedule.items()
+                    if next_check <= now)
+                if due:
+                    LOG.info('Checking %s projects', len(due))
+                    try:
+                        self.process(due)
+                    except Exception:
+                        LOG.exception('Could not process the projects')
+                    for project in due:
+                        if project in self.schedule:
+                            self.schedule[project] = time.time() + \
+                                get_interval(self.config, project)
+
+                wakeup = [time.time() + SERVE_MAX_SLEEP]
+                wakeup.extend(self.schedule.values())
+                next_check = self.monitor.step()
+                self.monitor.drain()
+                if next_check is not None:
+                    wakeup.append(next_check)
+                delay = min(wakeup) - time.time()
+                if delay > 0 and not self._stop and not self._reload:
+                    # Interrupted by the signals
+                    time.sleep(delay)
+        finally:
+            self.close()
+
+    def close(self):
+        ''' Close the readers, the copr session and the build state. '''
+        LOG.info('Stopping')
+        self.readers.close()
+        if self.client is not None:
+            self.client.close()
+        if self.state is not None:
+            self.state.close()
 
 
 def main():
@@ -578,61 +3800,30 @@ def main():
     config = ConfigParser.ConfigParser(defaults={'copr_config': None})
     config.read(args.config)
 
-    if not config.has_option('main', 'username'):
-        raise DgrocException(
-            'No `username` specified in the `main` section of the '
-            'configuration file.')
+    if args.action == 'status':
+        show_status(config)
+        return
 
-    if not config.has_option('main', 'email'):
-        raise DgrocException(
-            'No `email` specified in the `main` section of the '
-            'configuration file.')
+    init_rpm()
+    check_config(config)
 
-    srpms = {}
-    for project in config.sections():
-        if project == 'main':
-            continue
-        LOG.info('Processing project: %s', project)
-        try:
-            srpm = generate_new_srpm(config, project)
-            if srpm:
-                srpms[project] = srpm
-        except DgrocException, err:
-            LOG.info('%s: %s', project, err)
-
-    LOG.info('%s srpms generated', len(srpms))
-    if not srpms:
-        return
+    if args.jobs > 1 or not args.srpmonly or args.action == 'serve':
+        # Tag each log line with the project the worker is processing
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(
+                logging.Formatter('[%(threadName)s] %(message)s'))
 
-    if args.srpmonly:
+    METRICS.profile_dir = args.profile
+    if args.action == 'serve':
+        Daemon(args).run()
         return
 
+    METRICS.reset()
     try:
-        upload_srpms(config, srpms.values())
-    except DgrocException, err:
-        LOG.info(err)
-
-    try:
-        build_ids = copr_build(config, srpms)
-    except DgrocException, err:
-        LOG.info(err)
-
-    if args.monitoring:
-        LOG.info('Monitoring %s builds...', len(build_ids))
-        while build_ids:
-            time.sleep(45)
-            LOG.info(datetime.datetime.now())
-            build_ids = check_copr_build(config, build_ids)
+        build(config, args)
+    finally:
+        export_metrics(args)
 
 
 if __name__ == '__main__':
     main()
-    #build_ids = [6065]
-    #config = ConfigParser.ConfigParser()
-    #config.read(DEFAULT_CONFIG)
-    #print 'Monitoring builds...'
-    #build_ids = check_copr_build(config, build_ids)
-    #while build_ids:
-        #time.sleep(45)
-        #print datetime.datetime.now()
-        #build_ids = check_copr_build(config, build_ids)
@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+ (c) 2014 - Copyright Red Hat Inc
+
+ Authors:
+   Pierre-Yves Chibon <pingou@pingoured.fr>
+
+License: GPLv3 or any later version.
+
+A local stand-in for the parts of the copr API used by dgroc, keeping
+everything in memory. It is meant for benchmarking and testing dgroc
+without reaching a real copr instance.
+"""
+
+import argparse
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import time
+import urlparse
+
+
+# Chroots enabled in every project
+CHROOTS = ['fedora-rawhide-x86_64', 'epel-7-x86_64']
+# Repositories copr can build from
+SCM_TYPES = ('git', 'svn')
+
+
+class FakeCopr(object):
+    ''' The projects and builds known to the fake copr server. Projects are
+    created the first time they are looked up and each build goes through
+    the copr statuses on a timer, without anything being built.
+    '''
+
+    def __init__(self, build_time=5, chroots=None):
+        self.build_time = build_time
+        self.chroots = chroots or CHROOTS
+        self._lock = threading.Lock()
+        # (owner, name) -> project id
+        self.projects = {}
+        # build id -> dict
+        self.builds = {}
+        # path -> number of requests
+        self.requests = {}
+
+    def count(self, path):
+        ''' Count a request to the specified API endpoint. '''
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+    def project_id(self, owner, name):
+        ''' Return the id of the project, creating it if needed. '''
+        with self._lock:
+            if (owner, name) not in self.projects:
+                self.projects[(owner, name)] = len(self.projects) + 1
+            return self.projects[(owner, name)]
+
+    def add_build(self, project_id, srpm_url=None, srpm_size=0, scm=None):
+        ''' Record a new build of the project and return its id. The build
+        is either of a srpm or, for ``scm`` builds, of the commit of a
+        repository.
+        '''
+        with self._lock:
+            build_id = len(self.builds) + 1
+            self.builds[build_id] = {
+                'id': build_id,
+                'project_id': project_id,
+                'srpm_url': srpm_url,
+                'srpm_size': srpm_size,
+                'scm': scm,
+                'submitted_on': time.time(),
+                'canceled': False,
+            }
+        return build_id
+
+    def cancel(self, build_id):
+        ''' Cancel the build if it is not finished yet.
+        Returns whether the build was canceled, or None if it is unknown.
+        '''
+        status = self.status(build_id)
+        if status is None:
+            return None
+        if status not in ('pending', 'running'):
+            return False
+        with self._lock:
+            self.builds[build_id]['canceled'] = True
+        return True
+
+    def status(self, build_id):
+        ''' Return the current status of the build, or None if unknown. '''
+        with self._lock:
+            build = self.builds.get(build_id)
+        if build is None:
+            return None
+        if build['canceled']:
+            return 'canceled'
+        elapsed = time.time() - build['submitted_on']
+        if elapsed >= self.build_time:
+            return 'succeeded'
+        elif elapsed >= self.build_time / 2.0:
+            return 'running'
+        return 'pending'
+
+    def list_builds(self, project_id, limit):
+        ''' Return the last ``limit`` builds of the project. '''
+        with self._lock:
+            build_ids = sorted(
+                (build_id for build_id, build in self.builds.items()
+                 if build['project_id'] == project_id), reverse=True)
+        return [
+            {'id': build_id, 'project_id': project_id,
+             'state': self.status(build_id)}
+            for build_id in build_ids[:limit]]
+
+
+class FakeCoprHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' Answer the copr API requests from the FakeCopr of the server. '''
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        ''' Only log the requests when the server is verbose. '''
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, fmt, *args)
+
+    @property
+    def copr(self):
+        ''' The FakeCopr of the server. '''
+        return self.server.copr
+
+    def _reply(self, code, data=None, headers=None):
+        ''' Send the response, its body being ``data`` dumped to json. '''
+        body = json.dumps(data) if data is not None else ''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        ''' Read the body of the request, plain or chunked. '''
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return ''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _wait(self):
+        ''' Simulate the latency of the network and of copr. '''
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def do_GET(self):
+        ''' Answer the project, chroots and build status lookups. '''
+        url = urlparse.urlparse(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        parts = [part for part in url.path.split('/') if part]
+        self._wait()
+
+        if parts == ['api_2', 'projects']:
+            self.copr.count('api_2/projects')
+            project_id = self.copr.project_id(
+                params.get('owner'), params.get('name'))
+            self._reply(200, {'projects': [{'project': {
+                'id': project_id,
+                'owner': params.get('owner'),
+                'name': params.get('name'),
+            }}]})
+        elif len(parts) == 4 and parts[:2] == ['api_2', 'projects'] \
+                and parts[3] == 'chroots':
+            self.copr.count('api_2/projects/chroots')
+            self._reply(200, {'chroots': [
+                {'chroot': {'name': name}} for name in self.copr.chroots]})
+        elif parts == ['api_2', 'builds']:
+            self.copr.count('api_2/builds')
+            try:
+                project_id = int(params['project_id'])
+                limit = int(params.get('limit', 100))
+            except (KeyError, ValueError):
+                self._reply(400, {'message': 'Invalid project_id or limit'})
+                return
+            self._reply(200, {'builds': [
+                {'build': build}
+                for build in self.copr.list_builds(project_id, limit)]})
+        elif len(parts) == 4 and parts[:3] == ['api', 'coprs', 'build_status']:
+            self.copr.count('api/coprs/build_status')
+            status = None
+            if parts[3].isdigit():
+                status = self.copr.status(int(parts[3]))
+            if status is None:
+                self._reply(404, {'output': 'notok',
+                                  'error': 'Build not found'})
+            else:
+                self._reply(200, {'output': 'ok', 'status': status})
+        else:
+            self._reply(404, {'message': 'Not found: %s' % url.path})
+
+    def do_POST(self):
+        ''' Start a build, from an srpm url, an uploaded srpm or a
+        repository.
+        '''
+        url = urlparse.urlparse(self.path)
+        body = self._read_body()
+        self._wait()
+
+        if url.path.strip('/') == 'api_3/build/create/scm':
+            self._create_scm_build(body)
+            return
+        if url.path.strip('/') != 'api_2/builds':
+            self._reply(404, {'message': 'Not found: %s' % url.path})
+            return
+        self.copr.count('api_2/builds/create')
+
+        content_type = self.headers.get('Content-Type', '')
+        srpm_size = 0
+        try:
+            if content_type.startswith('multipart/form-data'):
+                metadata, srpm_size = self._parse_multipart(body, content_type)
+            else:
+                metadata = json.loads(body)
+            project_id = int(metadata['project_id'])
+        except (ValueError, KeyError, TypeError):
+            self._reply(400, {'message': 'Invalid build request'})
+            return
+
+        build_id = self.copr.add_build(
+            project_id, srpm_url=metadata.get('srpm_url'),
+            srpm_size=srpm_size)
+        self._reply(201, headers={'Location': '/api_2/builds/%s' % build_id})
+
+    def _create_scm_build(self, body):
+        ''' Start the build of the commit of a repository. '''
+        self.copr.count('api_3/build/create/scm')
+        try:
+            metadata = json.loads(body)
+            owner = metadata['ownername']
+            name = metadata['projectname']
+            scm = dict(
+                (key, metadata[key]) for key in ('clone_url', 'committish'))
+            scm['spec'] = metadata.get('spec')
+            scm['subdirectory'] = metadata.get('subdirectory', '')
+            scm_type = metadata.get('scm_type', 'git')
+        except (ValueError, KeyError, TypeError):
+            self._reply(400, {'error': 'Invalid build request'})
+            return
+        if scm_type not in SCM_TYPES or not scm['clone_url']:
+            self._reply(400, {'error': 'Invalid scm: %s' % scm_type})
+            return
+
+        build_id = self.copr.add_build(
+            self.copr.project_id(owner, name), scm=scm)
+        self._reply(200, {
+            'id': build_id,
+            'ownername': owner,
+            'projectname': name,
+            'state': self.copr.status(build_id),
+            'source_package': {'url': scm['clone_url']},
+        })
+
+    def do_PATCH(self):
+        ''' Cancel a build. '''
+        url = urlparse.urlparse(self.path)
+        body = self._read_body()
+        parts = [part for part in url.path.split('/') if part]
+        self._wait()
+
+        if len(parts) != 3 or parts[:2] != ['api_2', 'builds'] \
+                or not parts[2].isdigit():
+            self._reply(404, {'message': 'Not found: %s' % url.path})
+            return
+        self.copr.count('api_2/builds/update')
+        try:
+            state = json.loads(body)['state']
+        except (ValueError, KeyError, TypeError):
+            state = None
+        if state != 'canceled':
+            self._reply(400, {'message': 'Only canceling builds is supported'})
+            return
+
+        canceled = self.copr.cancel(int(parts[2]))
+        if canceled is None:
+            self._reply(404, {'message': 'Build not found'})
+        elif not canceled:
+            self._reply(400, {'message': 'Build already finished'})
+        else:
+            self._reply(204)
+
+    def _parse_multipart(self, body, content_type):
+        ''' Return the metadata and the size of the srpm of a multipart
+        build request.
+        '''
+        boundary = content_type.split('boundary=')[1].strip('"')
+        metadata = None
+        srpm_size = 0
+        for part in body.split('--%s' % boundary)[1:-1]:
+            headers, _, content = part.partition('\r\n\r\n')
+            content = content[:-2]
+            if 'name="metadata"' in headers:
+                metadata = json.loads(content)
+            elif 'name="srpm"' in headers:
+                srpm_size = len(content)
+        if metadata is None:
+            raise ValueError('No metadata in the build request')
+        return metadata, srpm_size
+
+
+class FakeCoprServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    ''' HTTP server answering the copr API requests from a FakeCopr. '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, copr=None, latency=0, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeCoprHandler)
+        self.copr = copr or FakeCopr()
+        self.latency = latency
+        self.verbose = verbose
+        self._thread = None
+
+    @property
+    def url(self):
+        ''' The url to use as ``copr_url`` to reach the server. '''
+        return 'http://%s:%s/' % self.server_address[:2]
+
+    def start(self):
+        ''' Serve the requests from a background thread. '''
+        self._thread = threading.Thread(
+            target=self.serve_forever, name='fakecopr')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        ''' Stop serving the requests. '''
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def get_arguments():
+    ''' Set the command line parser and retrieve the arguments provided
+    by the command line.
+    '''
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the copr API used by dgroc')
+    parser.add_argument(
+        '--host', default='127.0.0.1',
+        help='Address to listen on')
+    parser.add_argument(
+        '--port', type=int, default=8080,
+        help='Port to listen on')
+    parser.add_argument(
+        '--build-time', dest='build_time', type=float, default=5,
+        help='Number of seconds a build takes to succeed')
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='Number of seconds added to the handling of each request')
+    parser.add_argument(
+        '--verbose', action='store_true', default=False,
+        help='Log each request')
+    return parser.parse_args()
+
+
+def main():
+    ''' Run the fake copr server until interrupted. '''
+    args = get_arguments()
+    server = FakeCoprServer(
+        (args.host, args.port), FakeCopr(build_time=args.build_time),
+        latency=args.latency, verbose=args.verbose)
+    print('Fake copr listening on %s' % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()